@@ -2,7 +2,6 @@ from pycram.process_module import ProcessModule
 from pycram.bullet_world import BulletWorld
 from pycram.helper import transform
 import pycram.bullet_world_reasoning as btr
-import pybullet as p
 import numpy as np
 import time
 
@@ -14,10 +13,7 @@ def _apply_ik(robot, joint_poses):
     :param joint_poses: The joint poses to be applied
     :return: None
     """
-    for i in range(0, p.getNumJoints(robot.id)):
-        qIndex = p.getJointInfo(robot.id, i)[3]
-        if qIndex > -1:
-            p.resetJointState(robot.id, i, joint_poses[qIndex-7])
+    robot.set_joint_states(joint_poses)
 
 
 def _park_arms():
@@ -42,10 +38,9 @@ class Pr2Navigation(ProcessModule):
         if solution['cmd'] == 'navigate':
             robot = BulletWorld.robot
             robot.set_position_and_orientation(solution['target'], solution['orientation'])
-            for obj in BulletWorld.current_bullet_world.objects:
-                if btr.contact(robot, obj):
-                    if obj.name == "floor":
-                        continue
+            for obj in btr.colliding_objects(robot):
+                if obj.name == "floor":
+                    continue
 
 
 class Pr2PickUp(ProcessModule):
@@ -60,14 +55,12 @@ class Pr2PickUp(ProcessModule):
             target = object.get_position()
             if not btr.reachable_object(object, BulletWorld.robot, solution['gripper']):
                 raise btr.ReasoningError
-            inv = p.calculateInverseKinematics(robot.id, robot.get_link_id(solution['gripper']), target,
-                                               maxNumIterations=100)
+            inv = btr.calculate_ik(robot, solution['gripper'], target)
             _apply_ik(robot, inv)
+            object.set_position_and_orientation(robot.get_link_position(solution['gripper']), [0, 0, 0, 1])
             robot.attach(object, solution['gripper'])
             #time.sleep(0.3)
             #_park_arms()
-            pos = p.getLinkState(robot.id, robot.get_link_id(solution['gripper']))[0]
-            p.resetBasePositionAndOrientation(object.id, pos, [0, 0, 0, 1])
             #BulletWorld.current_bullet_world.simulate(1)
             time.sleep(0.5)
 
@@ -81,11 +74,10 @@ class Pr2Place(ProcessModule):
         if solution['cmd'] == 'place':
             object = solution['object']
             robot = BulletWorld.robot
-            inv = p.calculateInverseKinematics(robot.id, robot.get_link_id(solution['gripper']), solution['target'],
-                                           maxNumIterations=100)
+            inv = btr.calculate_ik(robot, solution['gripper'], solution['target'])
             _apply_ik(robot, inv)
-            p.resetBasePositionAndOrientation(object.id, solution['target'], [0, 0, 0, 1])
             robot.detach(object)
+            object.set_position_and_orientation(solution['target'], [0, 0, 0, 1])
             #_park_arms()
             time.sleep(0.5)
 
@@ -106,14 +98,14 @@ class Pr2Accessing(ProcessModule):
             drawer_handle = solution['drawer-handle']
             drawer_joint = solution['drawer-joint']
             dis = solution['distance']
-            inv = p.calculateInverseKinematics(robot.id, robot.get_link_id(gripper), kitchen.get_link_position(drawer_handle))
+            inv = btr.calculate_ik(robot, gripper, kitchen.get_link_position(drawer_handle))
             _apply_ik(robot, inv)
             time.sleep(0.2)
             han_pose = kitchen.get_link_position(drawer_handle)
             new_p = [han_pose[0] - dis, han_pose[1], han_pose[2]]
-            inv = p.calculateInverseKinematics(robot.id, robot.get_link_id(gripper), new_p)
+            inv = btr.calculate_ik(robot, gripper, new_p)
             _apply_ik(robot, inv)
-            p.resetJointState(kitchen.id, kitchen.get_joint_id(drawer_joint), 0.3)
+            kitchen.set_joint_state(drawer_joint, 0.3)
             spoon = BulletWorld.current_bullet_world.get_objects_by_name("spoon")[0]
             spoon.set_position([1.15, 0.7, 0.8])
             time.sleep(0.5)
@@ -140,14 +132,14 @@ class Pr2MoveHead(ProcessModule):
         if solutions['cmd'] == 'looking':
             target = solutions['target']
             robot = BulletWorld.robot
-            pose_in_pan = transform(target, robot.get_link_position("head_pan_link"))
-            pose_in_tilt = transform(target, robot.get_link_position("head_tilt_link"))
+            head_positions = robot.get_link_positions_and_orientations(["head_pan_link", "head_tilt_link"])[0]
+            pose_in_pan = transform(target, head_positions[0])
+            pose_in_tilt = transform(target, head_positions[1])
 
             new_pan = np.arctan([pose_in_pan[1], pose_in_pan[0]])
             new_tilt = np.arctan([-pose_in_tilt[2], pose_in_tilt[0]**2 + pose_in_tilt[1]**2])
 
-            p.resetJointState(robot.id, 19, new_pan[0])
-            p.resetJointState(robot.id, 20, new_tilt[0])
+            robot.set_joint_states([new_pan[0], new_tilt[0]], [19, 20])
 
 
 class Pr2MoveGripper(ProcessModule):
@@ -162,12 +154,10 @@ class Pr2MoveGripper(ProcessModule):
             gripper = solution['gripper']
             motion = solution['motion']
             if gripper == 'right':
-                p.resetJointState(robot.id, 57, 0 if motion == "close" else 0.548)
-                p.resetJointState(robot.id, 59, 0 if motion == "close" else 0.548)
+                robot.set_joint_states([0, 0] if motion == "close" else [0.548, 0.548], [57, 59])
                 time.sleep(0.5)
             if gripper == 'left':
-                p.resetJointState(robot.id, 79, 0 if motion == "close" else 0.548)
-                p.resetJointState(robot.id, 81, 0 if motion == "close" else 0.548)
+                robot.set_joint_states([0, 0] if motion == "close" else [0.548, 0.548], [79, 81])
                 time.sleep(0.5)
 
 
@@ -184,12 +174,8 @@ class Pr2Detecting(ProcessModule):
             cam_frame_name = solultion['cam_frame']
 
             objects = BulletWorld.current_bullet_world.objects
-            visible_objects = []
-            for obj in objects:
-                if obj.type == "environment":
-                    continue
-                if btr.visible(obj, robot.get_link_position(cam_frame_name)):
-                    visible_objects.append(obj)
+            objects = list(filter(lambda obj: obj.type != "environment", objects))
+            visible_objects = btr.visible_objects(robot.get_link_position(cam_frame_name), objects)
 
             for obj in visible_objects:
                 if obj.type == object_type:
@@ -206,7 +192,7 @@ class Pr2MoveTCP(ProcessModule):
             target = solution['target']
             gripper = solution['gripper']
             robot = BulletWorld.robot
-            inv = p.calculateInverseKinematics(robot.id, robot.get_link_id(gripper), target)
+            inv = btr.calculate_ik(robot, gripper, target)
             _apply_ik(robot, inv)
             time.sleep(0.5)
 
@@ -223,27 +209,19 @@ class Pr2MoveJoints(ProcessModule):
             right_arm_poses = solution['right-poses']
             left_arm_poses = solution['left-poses']
             if type(right_arm_poses) == list:
-                for i in range(0, 9):
-                    p.resetJointState(robot.id, i + 42, right_arm_poses[i])
+                robot.set_joint_states(right_arm_poses[:9], range(42, 51))
                 #time.sleep(0.5)
             elif type(right_arm_poses) == str and right_arm_poses == "park":
                 _park_arms()
                 #time.sleep(0.5)
 
             if type(left_arm_poses) == list:
-                for i in range(0, 9):
-                    p.resetJointState(robot.id, i + 64, left_arm_poses[i])
+                robot.set_joint_states(left_arm_poses[:9], range(64, 73))
                 #time.sleep(0.5)
             elif type(right_arm_poses) == str and left_arm_poses == "park":
                 _park_arms()
                 #time.sleep(0.5)
 
-            for at in BulletWorld.robot.attachments:
-                # lid = self.attachments[at][1]
-                lid = BulletWorld.robot.attachments[at][1]
-                new_p = p.getLinkState(BulletWorld.robot.id, lid)[0]
-                p.resetBasePositionAndOrientation(at.id, new_p, [0, 0, 0, 1])
-            BulletWorld.current_bullet_world.simulate(0.5)
             time.sleep(0.5)
 
 
@@ -255,7 +233,7 @@ class Pr2WorldStateDetecting(ProcessModule):
         solution = desig.reference()
         if solution['cmd'] == "world-state-detecting":
             obj_type = solution['object']
-            return list(filter(lambda obj: obj.type == obj_type, BulletWorld.current_bullet_world.objects))[0]
+            return BulletWorld.current_bullet_world.get_objects_by_type(obj_type)[0]
 
 
 pr2_navigation = Pr2Navigation()
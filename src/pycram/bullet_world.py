@@ -7,11 +7,15 @@ Object -- Representation of an object in the BulletWorld
 """
 
 import pybullet as p
+import numpy as np
 import threading
-import time
 import pathlib
 from .event import Event
+from .fluent import Fluent
 from .helper import transform
+from .spatial_index import SpatialIndex
+from .world_snapshot import SnapshotManager, WorldSnapshot, record_states
+from .world_state import WorldStateMirror
 
 
 class BulletWorld:
@@ -25,33 +29,115 @@ class BulletWorld:
     current_bullet_world = None
     robot = None
 
-    def __init__(self, type="GUI"):
+    def __init__(self, type="GUI", is_shadow_world=False):
         """
         The constructor initializes a new simulation. The parameter decides if the Simulation should be graphical or
         non-graphical. It can only exist one graphical simulation at the time, but an arbitrary amount of non-graphical.
 
         The BulletWorld object also initializes the Events for attachment, detachment and for manipulating the world.
         :param type: Can either be "GUI" for graphical or "DIRECT" for non-graphical. The default parameter is "GUI"
+        :param is_shadow_world: If True this world will not become the 'current_bullet_world', this is used for worlds
+                                which only mirror another world, e.g. the worlds of a BulletWorldPool
+
+        The attribute 'spatial_index' holds a SpatialIndex of the bounding boxes of all objects, which can be used to
+        find objects near a position, inside a box or along a ray.
+
+        The attribute 'state_mirror' holds a WorldStateMirror with the poses, joint states and attachments of all
+        objects in NumPy arrays, which can be read or copied without requests to the physics server.
+
+        The attribute 'snapshots' holds the SnapshotManager which saves and restores named or scoped snapshots.
+
+        The attribute 'camera_settings' can be set to a CameraSettings object of bullet_world_reasoning to change the
+        camera which is used by the visibility queries in this world.
         """
         self.objects = []
+        self._objects_by_id = {}
+        self._objects_by_name = {}
+        self._objects_by_type = {}
         self.client_id = -1
+        self.revision = 0
+        self.gravity = [0, 0, 0]
+        self.time_step = 1 / 240
+        self.sub_steps = 0
+        self.camera_settings = None
+        self.is_shadow_world = is_shadow_world
+        self._real_time = False
+        self._simulation_lock = threading.Lock()
+        # The number of simulations running in background threads, guarded by its own lock since the simulation lock
+        # is held while stepping
+        self._simulations = 0
+        self._simulations_lock = threading.Lock()
         self.detachment_event = Event()
         self.attachment_event = Event()
         self.manipulation_event = Event()
+        self.spatial_index = SpatialIndex(self)
+        self.snapshots = SnapshotManager(self)
+        self.state_mirror = WorldStateMirror(self)
         self._gui_thread = Gui(self, type)
         self._gui_thread.start()
-        time.sleep(0.1)
+        self._gui_thread.ready.wait()
         self.last_bullet_world = BulletWorld.current_bullet_world
-        BulletWorld.current_bullet_world = self
+        if not is_shadow_world:
+            BulletWorld.current_bullet_world = self
+
+    def add_object(self, object):
+        """
+        Registers an object in this BulletWorld. The object will be appended to the list of objects and added to the
+        indices which are used for the lookup by id, name and type, to the spatial index and to the state mirror. This
+        is called by the constructor of Object and should not be necessary to call by hand.
+        :param object: The object which should be registered
+        """
+        self.objects.append(object)
+        self._objects_by_id[object.id] = object
+        self._objects_by_name.setdefault(object.name, []).append(object)
+        self._objects_by_type.setdefault(object.type, []).append(object)
+        self.spatial_index.add(object)
+        self.state_mirror.add(object)
+
+    def remove_object(self, object):
+        """
+        Removes an object from this BulletWorld. The object will be detached from all objects it is attached to,
+        deleted from the indices and removed from the physics simulation.
+        :param object: The object which should be removed
+        """
+        for other in list(object.attachments.keys()):
+            object.detach(other)
+        self.objects.remove(object)
+        del self._objects_by_id[object.id]
+        self._objects_by_name[object.name].remove(object)
+        if not self._objects_by_name[object.name]:
+            del self._objects_by_name[object.name]
+        self._objects_by_type[object.type].remove(object)
+        if not self._objects_by_type[object.type]:
+            del self._objects_by_type[object.type]
+        self.spatial_index.remove(object)
+        self.state_mirror.remove(object)
+        p.removeBody(object.id, physicsClientId=self.client_id)
+        self.increment_revision()
 
     def get_objects_by_name(self, name):
-        return list(filter(lambda obj: obj.name == name, self.objects))
+        return list(self._objects_by_name.get(name, []))
 
     def get_objects_by_type(self, obj_type):
-        return list(filter(lambda obj: obj.type == obj_type, self.objects))
+        return list(self._objects_by_type.get(obj_type, []))
 
     def get_object_by_id(self, id):
-        return list(filter(lambda obj: obj.id == id, self.objects))[0]
+        return self._objects_by_id[id]
+
+    def get_positions_and_orientations(self, objects=None):
+        """
+        Returns the base positions and orientations of many objects at once. The result are two NumPy arrays, the first
+        one contains the positions as rows of x,y,z and the second one the orientations as rows of x,y,z,w quaternions.
+        The rows are in the same order as the given objects.
+        :param objects: The objects for which the poses should be returned, if None all objects of this world are used
+        :return: A Nx3 array of positions and a Nx4 array of orientations
+        """
+        objects = self.objects if objects is None else objects
+        positions = np.empty((len(objects), 3))
+        orientations = np.empty((len(objects), 4))
+        for i, obj in enumerate(objects):
+            positions[i], orientations[i] = p.getBasePositionAndOrientation(obj.id, physicsClientId=self.client_id)
+        return positions, orientations
 
     def get_attachment_event(self):
         return self.attachment_event
@@ -62,22 +148,169 @@ class BulletWorld:
     def get_manipulation_event(self):
         return self.manipulation_event
 
+    def increment_revision(self):
+        """
+        Increments the revision counter of this world. The revision is used by the objects to decide if their cached
+        poses and link states are still valid, so it has to be incremented whenever the state of the simulation is
+        changed without using the methods of Object, e.g. by calling pybullet directly.
+        """
+        self.revision += 1
+
+    def caching_enabled(self):
+        """
+        Returns True if the objects of this world are allowed to cache poses and link states. This is not the case if
+        the simulation runs in real time or in a background thread since the poses can change without the revision
+        being incremented.
+        """
+        return not self._real_time and self._simulations == 0
+
     def set_realtime(self, real_time):
+        self._real_time = real_time
         p.setRealTimeSimulation(1 if real_time else 0, self.client_id)
+        self.increment_revision()
 
     def set_gravity(self, velocity):
+        self.gravity = list(velocity)
         p.setGravity(velocity[0], velocity[1], velocity[2], physicsClientId=self.client_id)
 
     def set_robot(self, robot):
         BulletWorld.robot = robot
 
-    def simulate(self, seconds):
-        for i in range(0, int(seconds * 240)):
-            p.stepSimulation(self.client_id)
+    def set_time_step(self, time_step, sub_steps=0):
+        """
+        Sets the duration of a single step of the simulation.
+        :param time_step: The time step in seconds, pybullet recommends the default of 1/240
+        :param sub_steps: The number of sub steps into which every step is divided, 0 for no sub steps
+        """
+        self.time_step = time_step
+        self.sub_steps = sub_steps
+        p.setPhysicsEngineParameter(fixedTimeStep=time_step, numSubSteps=sub_steps, physicsClientId=self.client_id)
+
+    def simulate(self, seconds, until=None, check_interval=10):
+        """
+        Simulates the world for the given time with the time step of this world. The simulation can be stopped early
+        by a predicate, e.g. 'at_rest'.
+        :param seconds: The time which should be simulated in seconds
+        :param until: A function which gets this world and returns True if the simulation should stop, or None
+        :param check_interval: The number of steps after which the predicate is checked again
+        :return: The time that was simulated in seconds
+        """
+        with self._simulation_lock:
+            steps = int(round(seconds / self.time_step))
+            step = 0
+            while step < steps:
+                p.stepSimulation(self.client_id)
+                step += 1
+                if until is not None and step % check_interval == 0 and until(self):
+                    break
+            self.increment_revision()
+        self.manipulation_event(self, self.objects)
+        return step * self.time_step
+
+    def simulate_async(self, seconds, until=None, check_interval=10):
+        """
+        Simulates the world like 'simulate' but in a background thread. While any simulation runs the objects do not
+        cache their poses. Simulations which are started while another one runs wait until it is finished. The
+        manipulation event at the end of the simulation is fired from the background thread.
+        :param seconds: The time which should be simulated in seconds
+        :param until: A function which gets this world and returns True if the simulation should stop, or None
+        :param check_interval: The number of steps after which the predicate is checked again
+        :return: A Fluent which is None while the simulation runs and afterwards holds the simulated time in seconds, or
+                    the exception if the simulation or the predicate raised one
+        """
+        done = Fluent()
+
+        def run():
+            result = None
+            try:
+                result = self.simulate(seconds, until, check_interval)
+            except Exception as e:
+                result = e
+            finally:
+                self._end_async_simulation()
+                done.set_value(result)
+
+        # Counted before the thread starts, so no pose is cached between returning and the first step
+        with self._simulations_lock:
+            self._simulations += 1
+        try:
+            threading.Thread(target=run, daemon=True).start()
+        except Exception:
+            self._end_async_simulation()
+            raise
+        return done
+
+    def _end_async_simulation(self):
+        with self._simulations_lock:
+            self._simulations -= 1
+
+    def at_rest(self, velocity_threshold=1e-3):
+        """
+        Checks if all objects of this world are at rest, this can be used as predicate for 'simulate'.
+        :param velocity_threshold: The maximal linear and angular velocity of an object at rest
+        :return: True if no object moves faster than the threshold, False else
+        """
+        for obj in self.objects:
+            linear, angular = p.getBaseVelocity(obj.id, physicsClientId=self.client_id)
+            if max(map(abs, linear + angular)) > velocity_threshold:
+                return False
+        return True
+
+    def get_attachments(self):
+        """
+        Returns all attachments between the objects of this world.
+        :return: A set of tuples of the parent object, the attached child object and the names of the attached links
+                    of the parent and of the child, or None for the base of an object
+        """
+        attachments = set()
+        for obj in self.objects:
+            for other, (cid, parent_link_id, child_link_id) in obj.attachments.items():
+                if p.getConstraintInfo(cid, physicsClientId=self.client_id)[0] == obj.id:
+                    attachments.add((obj, other, None if parent_link_id == -1 else obj.link_names[parent_link_id],
+                                     None if child_link_id == -1 else other.link_names[child_link_id]))
+        return attachments
+
+    def save_snapshot(self, record=False):
+        """
+        Saves the current state of this world in memory. The world can be reset to this state with 'reset_to', which
+        is much faster than spawning the objects again. The snapshot has to be removed with the SnapshotManager
+        'snapshots' when it is not needed anymore.
+        :param record: If the poses and joint states of all objects should be recorded in the snapshot
+        :return: The WorldSnapshot of the current state
+        """
+        state_id = p.saveState(physicsClientId=self.client_id)
+        states = record_states(self) if record else None
+        return WorldSnapshot(state_id, list(self.objects), frozenset(self.get_attachments()), states)
+
+    def reset_to(self, snapshot):
+        """
+        Resets this world to a WorldSnapshot which was saved before. Objects which were spawned after the snapshot are
+        removed and the attachments are restored, the objects of the snapshot keep their handles. All objects of the
+        snapshot must still exist in this world.
+        :param snapshot: The WorldSnapshot to which the world should be reset
+        """
+        for obj in snapshot.objects:
+            if self._objects_by_id.get(obj.id) is not obj:
+                raise ValueError(f"The object {obj.name} of the snapshot was removed from the world")
+        snapshot_objects = set(snapshot.objects)
+        for obj in list(self.objects):
+            if obj not in snapshot_objects:
+                obj.remove()
+        attachments = self.get_attachments()
+        for parent, child, parent_link, child_link in attachments - snapshot.attachments:
+            parent.detach(child)
+        p.restoreState(snapshot.state_id, physicsClientId=self.client_id)
+        self.increment_revision()
+        for parent, child, parent_link, child_link in snapshot.attachments - attachments:
+            parent.attach(child, parent_link, child_link)
+        self.manipulation_event(self, self.objects)
 
     def exit(self):
-        BulletWorld.current_bullet_world = self.last_bullet_world
+        self.snapshots.clear()
+        if not self.is_shadow_world:
+            BulletWorld.current_bullet_world = self.last_bullet_world
         p.disconnect(self.client_id)
+        self._gui_thread.shutdown.set()
         self._gui_thread.join()
 
 
@@ -87,24 +320,30 @@ current_bullet_world = BulletWorld.current_bullet_world
 class Gui(threading.Thread):
     """
     This class is for internal use only. It initializes the physics simulation in a new thread an holds it active.
+    The event 'ready' is set as soon as the simulation is connected and the event 'shutdown' stops the thread.
     """
     def __init__(self, world, type):
         threading.Thread.__init__(self)
         self.world = world
         self.type = type
+        self.ready = threading.Event()
+        self.shutdown = threading.Event()
 
     def run(self):
         """
         This method initializes the new simulation and checks in an endless loop if it is still active. If it is the
-        thread will be suspended for 10 seconds, if it is not the method and thus the thread terminates.
+        thread waits for 10 seconds or until 'shutdown' is set, if it is not the method and thus the thread terminates.
         """
-        if self.type == "GUI":
-            self.world.client_id = p.connect(p.GUI)
-        else:
-            self.world.client_id = p.connect(p.DIRECT)
+        try:
+            if self.type == "GUI":
+                self.world.client_id = p.connect(p.GUI)
+            else:
+                self.world.client_id = p.connect(p.DIRECT)
+        finally:
+            self.ready.set()
 
-        while p.isConnected(self.world.client_id):
-            time.sleep(10)
+        while p.isConnected(self.world.client_id) and not self.shutdown.wait(10):
+            pass
 
 
 class Object:
@@ -130,17 +369,23 @@ class Object:
         self.name = name
         self.type = type
         self.path = path
-        self.id = _load_object(name, path, position, orientation, world, color)
-        self.joints = self._joint_or_link_name_to_id("joint")
-        self.links = self._joint_or_link_name_to_id("link")
+        self.color = color
+        self.id = _load_object(name, path, position, orientation, self.world, color)
+        self._load_joint_info()
         self.attachments = {}
-        self.world.objects.append(self)
+        self._attachment_transforms = {}
+        self._cache_revision = -1
+        self._base_state_cache = None
+        self._link_state_cache = {}
+        self._aabb_cache = None
+        self.world.add_object(self)
 
     def attach(self, object, parent_link=None, child_link=None):
         """
         This method attaches two objects. This will be done by creating a virtual fixed joint between the two objects.
         After the attachment the attachment event of the BulletWorld will be fired.
-        It can only exist one attachment between two objects.
+        It can only exist one attachment between two objects. The transform of the other object relative to the link is
+        recorded, whenever this object is moved or its joints change the other object is moved with it.
         :param object: The object which should be attached to this object
         :param parent_link: The Name of the link of this object to which the other object should be attached or -1
                                 for the base position
@@ -150,7 +395,7 @@ class Object:
             return
         parent_link_id = -1 if parent_link is None else self.links[parent_link]
         child_link_id = -1 if child_link is None else object.links[child_link]
-        world_gripper = p.getLinkState(self.id, parent_link_id)[4] if parent_link_id != -1 else self.get_position()
+        world_gripper = self._get_link_state(parent_link_id)[4] if parent_link_id != -1 else self.get_position()
         world_object = object.get_position()
         gripper_object = p.multiplyTransforms(p.invertTransform(world_gripper, [0, 0, 0, 1])[0], [0, 0, 0, 1],
                                               world_object, [0, 0, 0, 1], self.world.client_id)[0]
@@ -159,9 +404,16 @@ class Object:
                                  p.JOINT_FIXED,
                                  [0, 1, 0], gripper_object, [0, 0, 0],
                                  physicsClientId=self.world.client_id)
-        p.changeConstraint(cid, maxForce=30)
-        self.attachments[object] = cid, parent_link_id
-        object.attachments[self] = cid, parent_link_id
+        p.changeConstraint(cid, maxForce=30, physicsClientId=self.world.client_id)
+        self.attachments[object] = cid, parent_link_id, child_link_id
+        parent_frame = p.getLinkState(self.id, parent_link_id, computeForwardKinematics=1,
+                                      physicsClientId=self.world.client_id)[4:6] \
+            if parent_link_id != -1 else self._get_base_state()
+        inverse_position, inverse_orientation = p.invertTransform(parent_frame[0], parent_frame[1])
+        self._attachment_transforms[object] = (parent_link_id,) + p.multiplyTransforms(
+            inverse_position, inverse_orientation, object.get_position(), object.get_orientation())
+        object.attachments[self] = cid, parent_link_id, child_link_id
+        self.world.increment_revision()
         self.world.attachment_event(self, [self, object])
 
     def detach(self, object):
@@ -172,48 +424,149 @@ class Object:
         """
         if object not in self.attachments:
             return
-        p.removeConstraint(self.attachments[object][0])
+        p.removeConstraint(self.attachments[object][0], physicsClientId=self.world.client_id)
         del self.attachments[object]
         del object.attachments[self]
+        self._attachment_transforms.pop(object, None)
+        object._attachment_transforms.pop(self, None)
+        self.world.increment_revision()
         self.world.detachment_event(self, [self, object])
 
+    def remove(self):
+        """
+        Removes this object from the BulletWorld it was spawned in.
+        """
+        self.world.remove_object(self)
+
+    def _cache_valid(self):
+        """
+        Checks if the cached poses and link states of this object are still valid and clears them if they are not.
+        :return: True if caching is enabled in the world of this object, False else
+        """
+        if not self.world.caching_enabled():
+            return False
+        if self._cache_revision != self.world.revision:
+            self._cache_revision = self.world.revision
+            self._base_state_cache = None
+            self._link_state_cache = {}
+            self._aabb_cache = None
+        return True
+
+    def _get_base_state(self):
+        """
+        Returns the base position and orientation of this object. The result is cached until the revision of the world
+        changes.
+        """
+        if not self._cache_valid():
+            return p.getBasePositionAndOrientation(self.id, physicsClientId=self.world.client_id)
+        if self._base_state_cache is None:
+            self._base_state_cache = p.getBasePositionAndOrientation(self.id, physicsClientId=self.world.client_id)
+        return self._base_state_cache
+
+    def _get_link_state(self, link_id):
+        """
+        Returns the state of the link with the given id as returned by getLinkState. The result is cached until the
+        revision of the world changes.
+        :param link_id: The unique id of the link
+        """
+        if not self._cache_valid():
+            return p.getLinkState(self.id, link_id, physicsClientId=self.world.client_id)
+        if link_id not in self._link_state_cache:
+            self._link_state_cache[link_id] = p.getLinkState(self.id, link_id, physicsClientId=self.world.client_id)
+        return self._link_state_cache[link_id]
+
     def get_position(self):
-        return p.getBasePositionAndOrientation(self.id)[0]
+        return self._get_base_state()[0]
 
     def get_pose(self):
         return self.get_position()
 
     def get_orientation(self):
-        return p.getBasePositionAndOrientation(self.id)[1]
+        return self._get_base_state()[1]
 
     def set_position_and_orientation(self, position, orientation):
         p.resetBasePositionAndOrientation(self.id, position, orientation, self.world.client_id)
-        for at in self.attachments:
-            lid = self.attachments[at][1]
-            new_p = p.getLinkState(BulletWorld.robot.id, lid)[0]
-            p.resetBasePositionAndOrientation(at.id, new_p, at.get_orientation(), self.world.client_id)
-        self.world.simulate(1)
+        self._moved()
 
     def set_position(self, position):
         self.set_position_and_orientation(position, self.get_orientation())
 
     def set_orientation(self, orientation):
-        p.resetBasePositionAndOrientation(self.id, self.get_position(), orientation, self.world.client_id)
+        self.set_position_and_orientation(self.get_position(), orientation)
 
     def set_pose(self, position):
         self.set_position(position)
 
     def set_joint(self, joint, pose):
-        p.resetJointState(self.id, self.joints[joint], pose)
+        p.resetJointState(self.id, self.joints[joint], pose, physicsClientId=self.world.client_id)
+        self._moved()
 
-    def _joint_or_link_name_to_id(self, type):
-        nJoints = p.getNumJoints(self.id)
-        joint_name_to_id = {}
-        info = 1 if type == "joint" else 12
-        for i in range(0, nJoints):
-            joint_info = p.getJointInfo(self.id, i)
-            joint_name_to_id[joint_info[info].decode('utf-8')] = joint_info[0]
-        return joint_name_to_id
+    def _moved(self):
+        """
+        Moves all objects which are attached to this object, directly or through other attached objects, with their
+        relative transforms which were recorded by 'attach'. Afterwards the revision of the world is incremented and
+        the manipulation event is fired for this object and all moved objects.
+        """
+        moved = []
+        parents = [self]
+        visited = {self}
+        while parents:
+            children, frame_positions, frame_orientations, positions, orientations = [], [], [], [], []
+            for parent in parents:
+                transforms = [(child, transform) for child, transform in parent._attachment_transforms.items()
+                              if child not in visited]
+                if not transforms:
+                    continue
+                frames = {-1: p.getBasePositionAndOrientation(parent.id, physicsClientId=self.world.client_id)}
+                link_ids = sorted(set(transform[0] for child, transform in transforms) - {-1})
+                if link_ids:
+                    states = p.getLinkStates(parent.id, link_ids, computeForwardKinematics=1,
+                                             physicsClientId=self.world.client_id)
+                    frames.update({link_id: state[4:6] for link_id, state in zip(link_ids, states)})
+                for child, (link_id, position, orientation) in transforms:
+                    visited.add(child)
+                    children.append(child)
+                    frame_positions.append(frames[link_id][0])
+                    frame_orientations.append(frames[link_id][1])
+                    positions.append(position)
+                    orientations.append(orientation)
+            if children:
+                new_positions, new_orientations = _multiply_transforms(np.array(frame_positions),
+                                                                       np.array(frame_orientations),
+                                                                       np.array(positions), np.array(orientations))
+                for child, position, orientation in zip(children, new_positions.tolist(), new_orientations.tolist()):
+                    p.resetBasePositionAndOrientation(child.id, position, orientation, self.world.client_id)
+            moved.extend(children)
+            parents = children
+        self.world.increment_revision()
+        self.world.manipulation_event(self, [self] + moved)
+
+    def _load_joint_info(self):
+        """
+        Reads the information about all joints of this object once, so it does not have to be requested from the
+        physics server again. The information is stored in the following attributes, the arrays are indexed by the
+        joint id:
+        joints -- dictionary from joint names to joint ids
+        links -- dictionary from link names to link ids
+        joint_names, link_names -- the names of the joints and their child links
+        joint_types -- the pybullet joint types, e.g. pybullet.JOINT_REVOLUTE
+        joint_q_indices -- the position index of every joint in the state vector or -1 for fixed joints
+        joint_lower_limits, joint_upper_limits, joint_damping -- the limits and damping of every joint
+        movable_joints -- the ids of all joints which are not fixed, in the order in which pybullet returns joint
+                            poses, e.g. from calculateInverseKinematics
+        """
+        infos = [p.getJointInfo(self.id, i, physicsClientId=self.world.client_id)
+                 for i in range(p.getNumJoints(self.id, physicsClientId=self.world.client_id))]
+        self.joint_names = [info[1].decode('utf-8') for info in infos]
+        self.link_names = [info[12].decode('utf-8') for info in infos]
+        self.joints = {name: i for i, name in enumerate(self.joint_names)}
+        self.links = {name: i for i, name in enumerate(self.link_names)}
+        self.joint_types = np.array([info[2] for info in infos], dtype=int)
+        self.joint_q_indices = np.array([info[3] for info in infos], dtype=int)
+        self.joint_damping = np.array([info[6] for info in infos], dtype=float)
+        self.joint_lower_limits = np.array([info[8] for info in infos], dtype=float)
+        self.joint_upper_limits = np.array([info[9] for info in infos], dtype=float)
+        self.movable_joints = np.flatnonzero(self.joint_q_indices > -1)
 
     def get_joint_id(self, name):
         return self.joints[name]
@@ -222,16 +575,108 @@ class Object:
         return self.links[name]
 
     def get_link_position_and_orientation(self, name):
-        return p.getLinkState(self.id, self.links[name])[:2]
+        return self._get_link_state(self.links[name])[:2]
 
     def get_link_position(self, name):
-        return p.getLinkState(self.id, self.links[name])[0]
+        return self._get_link_state(self.links[name])[0]
 
     def get_link_orientation(self, name):
-        return p.getLinkState(self.id, self.links[name])[1]
+        return self._get_link_state(self.links[name])[1]
+
+    def get_link_positions_and_orientations(self, names=None):
+        """
+        Returns the positions and orientations of many links of this object with a single call to the physics server.
+        The result are two NumPy arrays in the same order as the given link names.
+        :param names: The names of the links, if None all links of this object are used
+        :return: A Nx3 array of link positions and a Nx4 array of link orientations
+        """
+        names = list(self.links.keys()) if names is None else names
+        if not names:
+            return np.empty((0, 3)), np.empty((0, 4))
+        states = p.getLinkStates(self.id, [self.links[name] for name in names], physicsClientId=self.world.client_id)
+        positions = np.array([state[0] for state in states])
+        orientations = np.array([state[1] for state in states])
+        return positions, orientations
+
+    def get_aabb(self):
+        """
+        Returns the axis aligned bounding box of this object, which encloses the base and all links. The bounding box is
+        cached until the revision of the world changes, since it needs one request to the physics server per link.
+        :return: Two read only NumPy arrays with the minimum and maximum coordinates of the bounding box
+        """
+        if self._cache_valid() and self._aabb_cache is not None:
+            return self._aabb_cache
+        aabbs = np.array([p.getAABB(self.id, link_id, physicsClientId=self.world.client_id)
+                          for link_id in [-1] + list(self.links.values())])
+        aabb = aabbs[:, 0].min(axis=0), aabbs[:, 1].max(axis=0)
+        for bound in aabb:
+            bound.setflags(write=False)
+        if self._cache_valid():
+            self._aabb_cache = aabb
+        return aabb
 
     def set_joint_state(self, joint_name, joint_pose):
-        p.resetJointState(self.id, self.get_joint_id(joint_name), joint_pose)
+        p.resetJointState(self.id, self.get_joint_id(joint_name), joint_pose, physicsClientId=self.world.client_id)
+        self._moved()
+
+    def set_joint_states(self, joint_poses, joints=None):
+        """
+        Sets the poses of many joints of this object with a single call to the physics server.
+        :param joint_poses: The poses of the joints as list or NumPy array in the same order as the joints
+        :param joints: The names or ids of the joints, if None all movable joints are used in the order of
+                        'movable_joints', which is the order of the results of the inverse kinematics
+        """
+        self._reset_joint_states(joints, joint_poses)
+        self._moved()
+
+    def get_joint_states(self, joints=None):
+        """
+        Returns the poses of many joints of this object with a single call to the physics server.
+        :param joints: The names or ids of the joints, if None all movable joints are used
+        :return: A NumPy array with the poses of the joints in the same order as the given joints
+        """
+        joint_ids = self._joint_ids(joints)
+        if not joint_ids:
+            return np.empty(0)
+        states = p.getJointStates(self.id, joint_ids, physicsClientId=self.world.client_id)
+        return np.array([state[0] for state in states])
+
+    def _reset_joint_states(self, joints, joint_poses):
+        """
+        Resets the poses of many joints like 'set_joint_states' but without firing the manipulation event, this is
+        used by reasoning queries which restore the state of the world afterwards.
+        """
+        joint_ids = self._joint_ids(joints)
+        if len(joint_poses) != len(joint_ids):
+            raise ValueError(f"Expected {len(joint_ids)} joint poses for the joints of {self.name}, "
+                             f"got {len(joint_poses)}")
+        if joint_ids:
+            p.resetJointStatesMultiDof(self.id, joint_ids, [[pose] for pose in joint_poses],
+                                       physicsClientId=self.world.client_id)
+        self.world.increment_revision()
+
+    def _joint_ids(self, joints):
+        if joints is None:
+            return self.movable_joints.tolist()
+        return [self.joints[joint] if isinstance(joint, str) else int(joint) for joint in joints]
+
+
+def _multiply_transforms(positions_a, orientations_a, positions_b, orientations_b):
+    """
+    Multiplies many transforms at once, like pybullet.multiplyTransforms for every row.
+    :param positions_a: A Nx3 array of the positions of the first transforms
+    :param orientations_a: A Nx4 array of the orientations of the first transforms as x,y,z,w quaternions
+    :param positions_b: A Nx3 array of the positions of the second transforms
+    :param orientations_b: A Nx4 array of the orientations of the second transforms
+    :return: A Nx3 array of positions and a Nx4 array of orientations
+    """
+    vector_a, w_a = orientations_a[:, :3], orientations_a[:, 3:]
+    vector_b, w_b = orientations_b[:, :3], orientations_b[:, 3:]
+    cross = np.cross(vector_a, positions_b)
+    rotated = positions_b + 2 * w_a * cross + 2 * np.cross(vector_a, cross)
+    orientations = np.hstack([w_a * vector_b + w_b * vector_a + np.cross(vector_a, vector_b),
+                              w_a * w_b - np.sum(vector_a * vector_b, axis=1, keepdims=True)])
+    return positions_a + rotated, orientations
 
 
 def _load_object(name, path, position, orientation, world, color):
@@ -0,0 +1,273 @@
+"""Implementation of a pool of non-graphical BulletWorlds for reasoning
+
+Classes:
+BulletWorldPool -- A pool of shadow worlds which mirror a BulletWorld and execute reasoning queries on them
+ShadowWorld -- A non-graphical copy of a BulletWorld
+WorldObserver -- Creates snapshots of the state of a BulletWorld which can be applied to shadow worlds
+"""
+
+import pybullet as p
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Hashable
+from contextlib import contextmanager
+from .bullet_world import BulletWorld, Object, _world_and_id
+
+# Spawning .obj and .stl files writes an .urdf file, so shadow worlds must not clone objects at the same time
+_clone_lock = threading.Lock()
+
+
+class ShadowWorld:
+    """
+    This class represents a non-graphical copy of a BulletWorld. The objects of the original world are cloned when the
+    shadow world is synchronized for the first time after they were spawned. Afterwards only poses, joint states and
+    attachments that changed are copied.
+    The original objects only need the attributes name, type, path and color and have to be hashable, so the original
+    world may also live in another process.
+    """
+
+    def __init__(self):
+        """
+        Creates a new DIRECT BulletWorld which will mirror another world. The shadow world will not become the
+        'current_bullet_world'.
+        """
+        self.shadow = BulletWorld("DIRECT", is_shadow_world=True)
+        self.objects = {}
+        self._originals = {}
+        self._states = {}
+        self._attachments = set()
+        self._gravity = None
+
+    def sync(self, snapshot):
+        """
+        Applies a snapshot of the original world to this shadow world. Objects which are not in the shadow world yet
+        will be cloned, objects which were removed from the original world will be removed, and only the poses and
+        joint states which differ from the last synchronization will be reset.
+        :param snapshot: The snapshot of the original world as created by WorldObserver
+        """
+        states, attachments, gravity = snapshot
+        for original in list(self.objects.keys()):
+            if original not in states:
+                self._remove(original)
+
+        changed = []
+        for original, state in states.items():
+            if original not in self.objects:
+                self._clone(original, state)
+            if self._states.get(original) != state:
+                self._apply(original, state)
+                changed.append(self.objects[original])
+        if changed:
+            self.shadow.increment_revision()
+            # The states are reset with pybullet directly, so the spatial index and the state mirror of the shadow
+            # world have to be told which objects moved
+            self.shadow.manipulation_event(self.shadow, changed)
+
+        for parent, child, parent_link, child_link in self._attachments - attachments:
+            if parent in self.objects and child in self.objects:
+                self.objects[parent].detach(self.objects[child])
+        for parent, child, parent_link, child_link in attachments - self._attachments:
+            self.objects[parent].attach(self.objects[child], parent_link, child_link)
+        self._attachments = set(attachments)
+
+        if gravity != self._gravity:
+            self.shadow.set_gravity(gravity)
+            self._gravity = gravity
+
+    def to_shadow(self, value):
+        """
+        Replaces objects of the original world with their counterpart in this shadow world. Lists, tuples and
+        dictionaries are replaced element wise, every other value is returned unchanged.
+        :param value: The value which should be translated
+        :return: The translated value
+        """
+        if isinstance(value, (list, tuple)):
+            return type(value)(map(self.to_shadow, value))
+        if isinstance(value, dict):
+            return {self.to_shadow(key): self.to_shadow(item) for key, item in value.items()}
+        if isinstance(value, Hashable) and value in self.objects:
+            return self.objects[value]
+        return value
+
+    def to_original(self, value):
+        """
+        Replaces objects of this shadow world with the objects of the original world, this is the inverse of
+        'to_shadow'.
+        :param value: The value which should be translated
+        :return: The translated value
+        """
+        if isinstance(value, (list, tuple)):
+            return type(value)(map(self.to_original, value))
+        if isinstance(value, dict):
+            return {self.to_original(key): self.to_original(item) for key, item in value.items()}
+        if isinstance(value, Hashable) and value in self._originals:
+            return self._originals[value]
+        return value
+
+    def exit(self):
+        self.shadow.exit()
+
+    def _clone(self, original, state):
+        with _clone_lock:
+            shadow = Object(original.name, original.type, original.path, state[0], state[1], self.shadow,
+                            original.color)
+        self.objects[original] = shadow
+        self._originals[shadow] = original
+
+    def _remove(self, original):
+        shadow = self.objects.pop(original)
+        del self._originals[shadow]
+        del self._states[original]
+        self._attachments = set(filter(lambda a: original not in a[:2], self._attachments))
+        shadow.remove()
+
+    def _apply(self, original, state):
+        shadow = self.objects[original]
+        previous = self._states.get(original)
+        p.resetBasePositionAndOrientation(shadow.id, state[0], state[1], physicsClientId=self.shadow.client_id)
+        for i, joint_pose in enumerate(state[2]):
+            if previous is None or previous[2][i] != joint_pose:
+                p.resetJointState(shadow.id, i, joint_pose, physicsClientId=self.shadow.client_id)
+        self._states[original] = state
+
+
+class BulletWorldPool:
+    """
+    The BulletWorldPool holds a number of shadow worlds which mirror a BulletWorld. Reasoning queries can be submitted
+    to the pool and will be executed in one of the shadow worlds in a separate thread, so they neither disturb nor
+    block the original world. Before a query is executed the shadow world will be synchronized with the state the
+    original world had when the query was submitted.
+    Only the objects of the original world, their base poses, joint states and attachments and the gravity are
+    mirrored. Bodies, constraints or physics parameters which are created or changed by calling pybullet directly in
+    the original world are not copied into the shadow worlds.
+    """
+
+    def __init__(self, size=2, world=None):
+        """
+        Creates the shadow worlds of this pool. The objects of the original world are cloned when a shadow world is
+        used for the first time.
+        :param size: The number of shadow worlds and thus the number of queries which can be executed at the same time
+        :param world: The BulletWorld which should be mirrored, if None the 'current_bullet_world' is used
+        """
+        self.world, _ = _world_and_id(world)
+        self._observer = WorldObserver(self.world)
+        self._shadows = []
+        self._free = queue.Queue()
+        for i in range(size):
+            shadow = ShadowWorld()
+            self._shadows.append(shadow)
+            self._free.put(shadow)
+        self._executor = ThreadPoolExecutor(max_workers=size)
+
+    def submit(self, query, *args, **kwargs):
+        """
+        Submits a reasoning query to this pool. The query has to accept the BulletWorld in which it should operate as
+        keyword argument 'world', like all queries in bullet_world_reasoning. Objects of the original world in the
+        arguments are replaced with their counterparts in the shadow world and objects in the result are replaced with
+        the objects of the original world.
+        :param query: The reasoning query, e.g. bullet_world_reasoning.stable
+        :param args: The arguments for the reasoning query
+        :param kwargs: The keyword arguments for the reasoning query
+        :return: A concurrent.futures.Future which holds the result of the query
+        """
+        snapshot = self._observer.capture()
+        return self._executor.submit(self._run, snapshot, query, args, kwargs)
+
+    @contextmanager
+    def acquire(self):
+        """
+        Blocks until a shadow world is free, synchronizes it with the original world and returns it for the duration of
+        the with block. This can be used to execute more than a single query in a shadow world.
+        """
+        snapshot = self._observer.capture()
+        shadow = self._free.get()
+        try:
+            shadow.sync(snapshot)
+            yield shadow
+        finally:
+            self._free.put(shadow)
+
+    def exit(self):
+        """
+        Waits for all submitted queries, unregisters from the events of the original world and closes the shadow worlds.
+        """
+        self._executor.shutdown(wait=True)
+        self._observer.exit()
+        for shadow in self._shadows:
+            shadow.exit()
+
+    def _run(self, snapshot, query, args, kwargs):
+        shadow = self._free.get()
+        try:
+            shadow.sync(snapshot)
+            args = shadow.to_shadow(args)
+            kwargs = {key: shadow.to_shadow(value) for key, value in kwargs.items()}
+            kwargs['world'] = shadow.shadow
+            return shadow.to_original(query(*args, **kwargs))
+        finally:
+            self._free.put(shadow)
+
+
+class WorldObserver:
+    """
+    The WorldObserver creates snapshots of the objects, poses, joint states and attachments of a BulletWorld. The
+    attachments are tracked through the attachment and detachment events of the world, poses and joint states are read
+    again whenever the revision of the world changed.
+    """
+
+    def __init__(self, world):
+        """
+        Reads the current attachments of the given world and registers for its attachment and detachment events.
+        :param world: The BulletWorld which should be observed
+        """
+        self.world = world
+        self._snapshot = None
+        self._snapshot_revision = -1
+        self._attachments = world.get_attachments()
+        world.attachment_event.add(self._on_attachment)
+        world.detachment_event.add(self._on_detachment)
+
+    def capture(self):
+        """
+        Reads the poses and joint states of all objects of the observed world. The snapshot is only read again if the
+        revision of the world changed, otherwise the previous snapshot is returned.
+        :return: A tuple of a dictionary from objects to their state, the set of attachments and the gravity
+        """
+        if self._snapshot_revision != self.world.revision or self._snapshot is None:
+            states = {}
+            for obj in self.world.objects:
+                pose = p.getBasePositionAndOrientation(obj.id, physicsClientId=self.world.client_id)
+                joints = p.getJointStates(obj.id, range(len(obj.joints)), physicsClientId=self.world.client_id) \
+                    if obj.joints else []
+                states[obj] = pose[0], pose[1], tuple(joint[0] for joint in joints)
+            self._snapshot = states, frozenset(self._attachments), tuple(self.world.gravity)
+            self._snapshot_revision = self.world.revision
+        return self._snapshot
+
+    def exit(self):
+        """
+        Unregisters from the events of the observed world.
+        """
+        self.world.attachment_event.remove(self._on_attachment)
+        self.world.detachment_event.remove(self._on_detachment)
+
+    def _on_attachment(self, sender, objects):
+        parent, child = objects
+        cid, parent_link_id, child_link_id = parent.attachments[child]
+        self._attachments.add((parent, child, _link_name(parent, parent_link_id), _link_name(child, child_link_id)))
+
+    def _on_detachment(self, sender, objects):
+        parent, child = objects
+        self._attachments = set(filter(lambda a: {a[0], a[1]} != {parent, child}, self._attachments))
+
+
+def _link_name(object, link_id):
+    """
+    Returns the name of the link with the given id or None for the base.
+    :param object: The object to which the link belongs
+    :param link_id: The id of the link or -1 for the base
+    """
+    if link_id == -1:
+        return None
+    return object.link_names[link_id]
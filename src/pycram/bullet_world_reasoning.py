@@ -1,6 +1,7 @@
 import pybullet as p
-import itertools
 import numpy as np
+import threading
+from collections import OrderedDict
 from .bullet_world import _world_and_id
 
 
@@ -14,22 +15,285 @@ class CollisionError(Exception):
         Exception.__init__(self, *args, **kwargs)
 
 
-def _get_seg_mask_for_target(cam_position, target_position):
+class CameraSettings:
+    """
+    The CameraSettings describe the camera which is used by the visibility queries. They can be passed to a single
+    query or set as 'camera_settings' of a BulletWorld to be used by all queries in this world.
+    If 'roi' is True only a window around the projected bounding box of the objects of interest is rendered, the rest
+    of the segmentation mask counts as background. This is much cheaper if the objects cover only a small part of the
+    image.
+    """
+
+    def __init__(self, width=256, height=256, fov=300, near=0.2, far=10, renderer=None, roi=False, roi_margin=2):
+        """
+        :param width: The width of the rendered image in pixels
+        :param height: The height of the rendered image in pixels
+        :param fov: The vertical field of view in degrees
+        :param near: The distance of the near plane
+        :param far: The distance of the far plane
+        :param renderer: The pybullet renderer, e.g. pybullet.ER_TINY_RENDERER, if None the default renderer is used
+        :param roi: If True only the region of interest around the objects is rendered
+        :param roi_margin: The number of pixels which are added on every side of the region of interest
+        """
+        self.width = width
+        self.height = height
+        self.fov = fov
+        self.near = near
+        self.far = far
+        self.renderer = renderer
+        self.roi = roi
+        self.roi_margin = roi_margin
+
+    def key(self):
+        """
+        Returns a tuple which identifies the rendered image, this is used to cache renderings.
+        """
+        return self.width, self.height, self.fov, self.near, self.far, self.renderer
+
+
+_default_camera_settings = CameraSettings()
+
+
+def _camera_settings(camera_settings, world):
+    """
+    Selects the camera settings for a query. These are the given settings or the settings of the world or the default
+    settings, in this order.
+    """
+    if camera_settings is not None:
+        return camera_settings
+    if world.camera_settings is not None:
+        return world.camera_settings
+    return _default_camera_settings
+
+
+def _get_roi(objects, view_matrix, projection_matrix, settings):
+    """
+    Projects the bounding boxes of the given objects into the image and returns the window of pixels which encloses
+    them.
+    :param objects: The objects of interest
+    :param view_matrix: The view matrix as returned by computeViewMatrix
+    :param projection_matrix: The projection matrix as returned by computeProjectionMatrixFOV
+    :param settings: The CameraSettings
+    :return: The window as column and row ranges x0, x1, y0, y1 or None if the objects are not completely in front of
+                the camera
+    """
+    corners = []
+    for obj in objects:
+        aabb_min, aabb_max = obj.get_aabb()
+        for i in range(8):
+            corners.append([aabb_max[k] if i & (1 << k) else aabb_min[k] for k in range(3)] + [1])
+    # pybullet returns the matrices in column major order
+    clip = np.array(corners) @ (np.reshape(projection_matrix, (4, 4)).T @ np.reshape(view_matrix, (4, 4)).T).T
+    if np.any(clip[:, 3] <= 0):
+        return None
+    ndc = clip[:, :2] / clip[:, 3:]
+    columns = (ndc[:, 0] + 1) / 2 * settings.width
+    rows = (1 - ndc[:, 1]) / 2 * settings.height
+    x0 = int(max(np.floor(columns.min()) - settings.roi_margin, 0))
+    x1 = int(min(np.ceil(columns.max()) + settings.roi_margin, settings.width))
+    y0 = int(max(np.floor(rows.min()) - settings.roi_margin, 0))
+    y1 = int(min(np.ceil(rows.max()) + settings.roi_margin, settings.height))
+    return x0, max(x1, x0), y0, max(y1, y0)
+
+
+def _get_roi_projection_matrix(projection_matrix, roi, settings):
+    """
+    Calculates a projection matrix which maps the given window of the image to the complete image, so rendering with
+    this matrix and the size of the window yields exactly the pixels of the window.
+    """
+    x0, x1, y0, y1 = roi
+    left, right = 2 * x0 / settings.width - 1, 2 * x1 / settings.width - 1
+    bottom, top = 1 - 2 * y1 / settings.height, 1 - 2 * y0 / settings.height
+    window = np.array([[2 / (right - left), 0, 0, -(right + left) / (right - left)],
+                       [0, 2 / (top - bottom), 0, -(top + bottom) / (top - bottom)],
+                       [0, 0, 1, 0],
+                       [0, 0, 0, 1]])
+    return (window @ np.reshape(projection_matrix, (4, 4)).T).T.flatten().tolist()
+
+
+def _get_view_projection(cam_position, target_position, settings):
+    """
+    Returns the matrix which maps homogeneous world coordinates to the clip coordinates of the camera.
+    """
+    view_matrix = p.computeViewMatrix(cam_position, target_position, [-1, 0, -1])
+    projection_matrix = p.computeProjectionMatrixFOV(settings.fov, settings.width / settings.height, settings.near,
+                                                     settings.far)
+    # pybullet returns the matrices in column major order
+    return np.reshape(projection_matrix, (4, 4)).T @ np.reshape(view_matrix, (4, 4)).T
+
+
+def _reproject_mask(mask, cam_position, mask_target, target_position, settings):
+    """
+    Transfers a mask which was rendered with the camera pointing at one target into the image of the camera pointing at
+    another target. Both images are taken from the same position, so every pixel of the new image is looked up in the
+    given mask along its viewing ray.
+    :param mask: The boolean mask rendered with the camera pointing at 'mask_target'
+    :param cam_position: The position of the camera
+    :param mask_target: The position the camera pointed at when the mask was rendered
+    :param target_position: The position the camera points at in the new image
+    :param settings: The CameraSettings of both images
+    :return: A boolean mask with the size of the image which is True for the pixels of the new image that show the mask
+    """
+    rows, columns = np.indices((settings.height, settings.width))
+    ndc = np.stack([(columns.ravel() + 0.5) / settings.width * 2 - 1, 1 - (rows.ravel() + 0.5) / settings.height * 2,
+                    np.full(rows.size, 0.5), np.ones(rows.size)], axis=1)
+    clip = ndc @ (_get_view_projection(cam_position, mask_target, settings) @
+                  np.linalg.inv(_get_view_projection(cam_position, target_position, settings))).T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        column = np.floor((clip[:, 0] / clip[:, 3] + 1) / 2 * settings.width)
+        row = np.floor((1 - clip[:, 1] / clip[:, 3]) / 2 * settings.height)
+    inside = (clip[:, 3] > 0) & (column >= 0) & (column < settings.width) & (row >= 0) & (row < settings.height)
+    result = np.zeros(rows.size, dtype=bool)
+    result[inside] = mask[row[inside].astype(int), column[inside].astype(int)]
+    return result.reshape(settings.height, settings.width)
+
+
+def _get_seg_mask_for_target(cam_position, target_position, world_id, settings=_default_camera_settings,
+                             roi_objects=None):
     """
     Calculates the view and projection Matrix and returns the Segmentation mask
     The segmentation mask indicates for every pixel the visible Object.
     :param cam_position: The position of the Camera as a list of x,y,z
     :param target_position: The position to which the camera should point as a list of x,y,z
-    :return: The Segmentation mask from the camera position
+    :param world_id: The id of the physics client which should be rendered
+    :param settings: The CameraSettings which should be used
+    :param roi_objects: The objects of interest, if the settings enable the region of interest only the pixels around
+                        these objects are rendered
+    :return: The Segmentation mask from the camera position as NumPy array of object ids with the size of the image
     """
-    fov = 300
-    aspect = 256 / 256
-    near = 0.2
-    far = 10
+    aspect = settings.width / settings.height
+    kwargs = {} if settings.renderer is None else {'renderer': settings.renderer}
 
     view_matrix = p.computeViewMatrix(cam_position, target_position, [-1, 0, -1])
-    projection_matrix = p.computeProjectionMatrixFOV(fov, aspect, near, far)
-    return p.getCameraImage(256, 256, view_matrix, projection_matrix)[4]
+    projection_matrix = p.computeProjectionMatrixFOV(settings.fov, aspect, settings.near, settings.far)
+    roi = _get_roi(roi_objects, view_matrix, projection_matrix, settings) if settings.roi and roi_objects else None
+    if roi is None:
+        seg_mask = p.getCameraImage(settings.width, settings.height, view_matrix, projection_matrix,
+                                    physicsClientId=world_id, **kwargs)[4]
+        return np.reshape(np.asarray(seg_mask, dtype=np.int64), (settings.height, settings.width))
+
+    x0, x1, y0, y1 = roi
+    full_mask = np.full((settings.height, settings.width), -1, dtype=np.int64)
+    if x1 > x0 and y1 > y0:
+        seg_mask = p.getCameraImage(x1 - x0, y1 - y0, view_matrix,
+                                    _get_roi_projection_matrix(projection_matrix, roi, settings),
+                                    physicsClientId=world_id, **kwargs)[4]
+        full_mask[y0:y1, x0:x1] = np.reshape(np.asarray(seg_mask, dtype=np.int64), (y1 - y0, x1 - x0))
+    return full_mask
+
+
+def _get_isolated_seg_masks(objects, cam_position, world, world_id, settings=_default_camera_settings):
+    """
+    Renders every given object without the rest of the world, with the camera pointing at the position of the object.
+    All objects are moved out of sight once, then every given object is moved back, rendered and moved out of sight
+    again, so the world is changed only once for all objects. The state of the world is restored afterwards.
+    :param objects: The objects which should be rendered
+    :param cam_position: The position of the Camera as a list of x,y,z
+    :param world: The BulletWorld which should be rendered
+    :param world_id: The id of the physics client of the world
+    :param settings: The CameraSettings which should be used
+    :return: A list of segmentation masks as NumPy arrays of object ids in the order of the objects
+    """
+    poses = [(obj.get_position(), obj.get_orientation()) for obj in objects]
+    seg_masks = []
+    with world.snapshots.scoped(physics_only=True):
+        for obj in world.objects:
+            # p.removeBody(object.id, physicsClientId=world_id)
+            # Hot fix until I come up with something better
+            p.resetBasePositionAndOrientation(obj.id, [100, 100, 100], [0, 0, 0, 1], world_id)
+        for obj, (position, orientation) in zip(objects, poses):
+            p.resetBasePositionAndOrientation(obj.id, position, orientation, world_id)
+            seg_masks.append(_get_seg_mask_for_target(cam_position, position, world_id, settings, [obj]))
+            p.resetBasePositionAndOrientation(obj.id, [100, 100, 100], [0, 0, 0, 1], world_id)
+    return seg_masks
+
+
+class _LRUCache:
+    """
+    This class is for internal use only. It is a dictionary with a maximal size, once it is full the least recently
+    used entries are removed. All accesses are guarded by a lock, since the queries which use the caches may run in
+    the threads of a BulletWorldPool at the same time.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# The pixels an object covers if it is rendered without the rest of the world, stored as boolean masks
+_solo_render_cache = _LRUCache()
+
+
+def clear_render_cache():
+    """
+    Removes all cached renderings of single objects which are used by 'visible', 'visible_objects' and 'occluding'.
+    """
+    _solo_render_cache.clear()
+
+
+def _quantize(values, resolution=1e-3):
+    return tuple(np.round(np.asarray(values, dtype=float) / resolution).astype(np.int64).tolist())
+
+
+def _get_solo_masks(objects, cam_position, world, world_id, settings=_default_camera_settings):
+    """
+    Returns for every object the pixels it covers if it is rendered without the rest of the world and the camera
+    points at the position of the object. The masks are cached for the position of the camera and the pose and joint
+    states of the object, so an object only has to be rendered alone again if the camera or the object itself moved.
+    All objects which are not cached are rendered together with '_get_isolated_seg_masks'.
+    :param objects: The objects which should be rendered
+    :param cam_position: The position of the Camera as a list of x,y,z
+    :param world: The BulletWorld in which the objects are
+    :param world_id: The id of the physics client of the world
+    :param settings: The CameraSettings which should be used
+    :return: A list of boolean NumPy arrays which are True for every pixel that shows the object, in the order of the
+                objects
+    """
+    keys = []
+    for obj in objects:
+        joints = p.getJointStates(obj.id, range(len(obj.joints)), physicsClientId=world_id) if obj.joints else []
+        keys.append((world_id, obj.id, obj.path, _quantize(cam_position), _quantize(obj.get_position()),
+                     _quantize(obj.get_orientation()), _quantize(list(map(lambda joint: joint[0], joints))),
+                     settings.key()))
+    masks = [_solo_render_cache.get(key) for key in keys]
+    missing = [i for i, mask in enumerate(masks) if mask is None]
+    if missing:
+        seg_masks = _get_isolated_seg_masks([objects[i] for i in missing], cam_position, world, world_id, settings)
+        for i, seg_mask in zip(missing, seg_masks):
+            masks[i] = seg_mask == objects[i].id
+            _solo_render_cache.put(keys[i], masks[i])
+    return masks
+
+
+def _pixel_counts(seg_mask, ids):
+    """
+    Counts for every given object id the pixels which show this object in the segmentation mask.
+    :param seg_mask: The segmentation mask as NumPy array
+    :param ids: The object ids for which the pixels should be counted
+    :return: A NumPy array with the pixel counts in the same order as the ids
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    counts = np.bincount(seg_mask[seg_mask >= 0], minlength=ids.max() + 1 if len(ids) else 0)
+    return counts[ids]
 
 
 def _get_joint_ranges(robot):
@@ -40,60 +304,288 @@ def _get_joint_ranges(robot):
     :param robot: The robot for whom the values should be calculated
     :return: The lists for the upper and lower limits, joint ranges, rest poses and joint damping
     """
-    ll, ul, jr, rp, jd = [], [], [], [], []
-
-    for i in range(0, p.getNumJoints(robot.id)):
-        info = p.getJointInfo(robot.id, i)
-        if info[3] > -1:
-            ll.append(info[8])
-            ul.append(info[9])
-            jr.append(info[9] - info[8])
-            rp.append(p.getJointState(robot.id, i)[0])
-            jd.append(info[6])
+    movable = robot.movable_joints
+    ll = robot.joint_lower_limits[movable].tolist()
+    ul = robot.joint_upper_limits[movable].tolist()
+    jr = (robot.joint_upper_limits[movable] - robot.joint_lower_limits[movable]).tolist()
+    rp = robot.get_joint_states().tolist()
+    jd = robot.joint_damping[movable].tolist()
 
     return ll, ul, jr, rp, jd
 
 
-def stable(object, world=None):
+class IKCache(_LRUCache):
+    """
+    The IKCache stores the solutions of the inverse kinematics. The solutions are stored for the robot, the end
+    effector, the quantized target position and the quantized pose of the robot including all joint states, since the
+    solver of pybullet starts from the current joint states. If the cache is full the least recently used solution is
+    removed.
+
+    The attributes 'hits' and 'misses' count how often a solution was found in the cache and how often it had to be
+    calculated.
+    """
+
+    def __init__(self, maxsize=1024, resolution=1e-4):
+        """
+        :param maxsize: The maximal number of solutions in the cache
+        :param resolution: The resolution to which the target position and the joint states are rounded
+        """
+        _LRUCache.__init__(self, maxsize)
+        self.resolution = resolution
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            solution = self._entries.get(key)
+            if solution is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return solution
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+ik_cache = IKCache()
+
+
+def calculate_ik(robot, gripper_name, pose, world=None, max_iterations=100):
+    """
+    Calculates the inverse kinematics for an end effector of a robot and a target position. Solutions are looked up in
+    'ik_cache' first, so solving the same problem for the same robot state more than once, e.g. when checking if an
+    object is reachable and then picking it up, solves it only once.
+    :param robot: The robot for which the inverse kinematics should be calculated
+    :param gripper_name: The name of the end effector
+    :param pose: The target position for the end effector
+    :param world: The BulletWorld if more than one BulletWorld is active
+    :param max_iterations: The maximal number of iterations of the solver
+    :return: The joint states for all movable joints of the robot
+    """
+    world, world_id = _world_and_id(world)
+    link_id = robot.get_link_id(gripper_name)
+    resolution = ik_cache.resolution
+    key = (world_id, robot.id, link_id, max_iterations, _quantize(pose, resolution),
+           _quantize(robot.get_position(), resolution), _quantize(robot.get_orientation(), resolution),
+           _quantize(robot.get_joint_states(), resolution))
+    solution = ik_cache.get(key)
+    if solution is None:
+        solution = p.calculateInverseKinematics(robot.id, link_id, pose, maxNumIterations=max_iterations,
+                                                physicsClientId=world_id)
+        ik_cache.put(key, solution)
+    return solution
+
+
+def _convex_hull(points):
     """
-    This reasoning query checks if an object is stable in the world. This will be done by simulating the world for 10 seconds
-    and compare the previous coordinates with the coordinates after the simulation.
+    Calculates the convex hull of 2D points with the monotone chain algorithm.
+    :param points: A list of x,y points
+    :return: The points of the hull in counter clockwise order
+    """
+    points = sorted(set(map(tuple, points)))
+    if len(points) < 3:
+        return points
+
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    lower, upper = [], []
+    for point in points:
+        while len(lower) >= 2 and cross(lower[-2], lower[-1], point) <= 0:
+            lower.pop()
+        lower.append(point)
+    for point in reversed(points):
+        while len(upper) >= 2 and cross(upper[-2], upper[-1], point) <= 0:
+            upper.pop()
+        upper.append(point)
+    return lower[:-1] + upper[:-1]
+
+
+def _resting_on_static_support(object, world_id, velocity_threshold, min_normal_z=0.9):
+    """
+    Checks without simulating if an object rests on static supports. This is the case if the object does not move, it
+    only touches bodies without mass, all contact normals point upwards and its center of mass lies above the convex
+    hull of the contact points.
+    :param object: The object which should be checked
+    :param world_id: The id of the physics client
+    :param velocity_threshold: The linear and angular velocity below which the object counts as resting
+    :param min_normal_z: The minimal z component of the contact normals
+    :return: True if the object rests on static supports, False if this can not be decided without simulating
+    """
+    linear, angular = p.getBaseVelocity(object.id, physicsClientId=world_id)
+    if np.linalg.norm(linear) > velocity_threshold or np.linalg.norm(angular) > velocity_threshold:
+        return False
+    p.performCollisionDetection(physicsClientId=world_id)
+    contact_points = p.getContactPoints(bodyA=object.id, physicsClientId=world_id)
+    if len(contact_points) < 3:
+        return False
+    for point in contact_points:
+        if p.getDynamicsInfo(point[2], point[4], physicsClientId=world_id)[0] != 0 or point[7][2] < min_normal_z:
+            return False
+
+    hull = _convex_hull([point[6][:2] for point in contact_points])
+    if len(hull) < 3:
+        return False
+    com = p.getBasePositionAndOrientation(object.id, physicsClientId=world_id)[0]
+    for i in range(len(hull)):
+        a, b = hull[i], hull[(i + 1) % len(hull)]
+        if (b[0] - a[0]) * (com[1] - a[1]) - (b[1] - a[1]) * (com[0] - a[0]) < 0:
+            return False
+    return True
+
+
+def stable(object, world=None, max_steps=480, tolerance=1e-3, velocity_threshold=1e-3, rest_steps=10):
+    """
+    This reasoning query checks if an object is stable in the world. This will be done by simulating the world for up to
+    2 seconds and comparing the previous coordinates with the coordinates during the simulation. The simulation stops
+    early if the object moved further than the tolerance, then it is not stable, or if it came to rest for a number of
+    steps, then it is stable. Objects which rest on static supports, like the floor, are recognized without simulating.
     :param object: The object which should be checked
     :param world: The BulletWorld if more than one BulletWorld is active
+    :param max_steps: The maximal number of simulation steps, one step is approximately 1/240 seconds
+    :param tolerance: The distance the object may move and still count as stable
+    :param velocity_threshold: The linear and angular velocity below which the object counts as resting
+    :param rest_steps: The number of consecutive steps the object has to rest to count as stable
     :return: True if the given object is stable in the world False else
     """
-    world, world_id = _world_and_id(world)
-    coords_prev = p.getBasePositionAndOrientation(object.id, physicsClientId=world_id)[0]
-    state = p.saveState()
-    p.setGravity(0, 0, -9.8)
-
-    # one Step is approximately 1/240 seconds
-    for i in range(0, 2 * 240):
-        p.stepSimulation(physicsClientId=world_id)
-    coords_past = p.getBasePositionAndOrientation(object.id, physicsClientId=world_id)[0]
-
-    p.restoreState(state)
-    coords_prev = list(map(lambda n: round(n, 3), coords_prev))
-    coords_past = list(map(lambda n: round(n, 3), coords_past))
-    return coords_past == coords_prev
+    return stable_all([object], world, max_steps, tolerance, velocity_threshold, rest_steps)[0]
 
 
-def contact(object1, object2, world=None):
+def stable_all(objects, world=None, max_steps=480, tolerance=1e-3, velocity_threshold=1e-3, rest_steps=10):
     """
-    This reasoning query checks if two objects are in contact or not.
+    This reasoning query checks for many objects at once if they are stable in the world. This works like 'stable', but
+    the world is simulated only once for all objects. The simulation stops as soon as the stability of every object is
+    decided.
+    :param objects: The objects which should be checked
+    :param world: The BulletWorld if more than one BulletWorld is active
+    :param max_steps: The maximal number of simulation steps, one step is approximately 1/240 seconds
+    :param tolerance: The distance an object may move and still count as stable
+    :param velocity_threshold: The linear and angular velocity below which an object counts as resting
+    :param rest_steps: The number of consecutive steps an object has to rest to count as stable
+    :return: A list with True for every stable object and False for every other object, in the order of the objects
+    """
+    world, world_id = _world_and_id(world)
+    p.setGravity(0, 0, -9.8, physicsClientId=world_id)
+    # None means the stability of the object is not decided yet
+    result = [True if _resting_on_static_support(obj, world_id, velocity_threshold) else None for obj in objects]
+    undecided = [i for i in range(len(objects)) if result[i] is None]
+    if not undecided:
+        return result
+
+    coords_prev = np.array([p.getBasePositionAndOrientation(objects[i].id, physicsClientId=world_id)[0]
+                            for i in undecided])
+    resting = np.zeros(len(undecided), dtype=int)
+    with world.snapshots.scoped(physics_only=True):
+        for step in range(0, max_steps):
+            p.stepSimulation(physicsClientId=world_id)
+            coords = np.array([p.getBasePositionAndOrientation(objects[i].id, physicsClientId=world_id)[0]
+                               for i in undecided])
+            velocities = np.array([np.concatenate(p.getBaseVelocity(objects[i].id, physicsClientId=world_id))
+                                   for i in undecided])
+            moved = np.linalg.norm(coords - coords_prev, axis=1) > tolerance
+            at_rest = (np.linalg.norm(velocities[:, :3], axis=1) < velocity_threshold) & \
+                      (np.linalg.norm(velocities[:, 3:], axis=1) < velocity_threshold)
+            resting = np.where(at_rest, resting + 1, 0)
+
+            keep = []
+            for k, i in enumerate(undecided):
+                if moved[k]:
+                    result[i] = False
+                elif resting[k] >= rest_steps:
+                    result[i] = True
+                else:
+                    keep.append(k)
+            if not keep:
+                break
+            undecided = [undecided[k] for k in keep]
+            coords_prev, resting = coords_prev[keep], resting[keep]
+
+    # Objects which neither came to rest nor moved out of the tolerance, e.g. because they are slowly sliding
+    return [True if r is None else r for r in result]
+
+
+def contact(object1, object2, world=None, margin=1e-3):
+    """
+    This reasoning query checks if two objects are in contact or not. The distance between the collision shapes is
+    calculated for the current poses, the simulation is not stepped and the world is not changed.
     :param object1: The first object
     :param object2: The second object
     :param world: The BulletWorld if more than one BulletWorld is active
+    :param margin: The maximal distance between the objects for them to be in contact, the default is small but not
+                    zero so objects which only touch each other are in contact as well
     :return: True if the two objects are in contact False else
     """
     world, world_id = _world_and_id(world)
-    p.stepSimulation(world_id)
-    con_points = p.getContactPoints(object1.id, object2.id, physicsClientId=world_id)
+    return len(p.getClosestPoints(object1.id, object2.id, margin, physicsClientId=world_id)) > 0
+
+
+def contact_points(object, objects=None, world=None, margin=1e-3):
+    """
+    This reasoning query checks one object against many objects at once and returns the contact points for every
+    object which is in contact with it. The candidates are found with 'overlapping_objects', so only objects near the
+    given one are checked. Like 'contact' this does not step the simulation.
+    :param object: The object for which the contacts should be found
+    :param objects: The objects which should be checked, if None all objects of the world are checked
+    :param world: The BulletWorld if more than one BulletWorld is active
+    :param margin: The maximal distance between two objects for them to be in contact
+    :return: A dictionary from every object in contact to the list of its contact points as returned by
+                getClosestPoints, where bodyA is the given object
+    """
+    world, world_id = _world_and_id(world)
+    candidates = overlapping_objects(object, world, margin)
+    if objects is not None:
+        ids = set(map(lambda obj: obj.id, objects))
+        candidates = [obj for obj in candidates if obj.id in ids]
+    points = {}
+    for obj in candidates:
+        closest = p.getClosestPoints(object.id, obj.id, margin, physicsClientId=world_id)
+        if closest:
+            points[obj] = closest
+    return points
+
+
+def overlapping_objects(object, world=None, margin=0.0):
+    """
+    This reasoning query is a broad phase for collision checks. It returns all objects whose axis aligned bounding box
+    overlaps the bounding box of the given object, only these objects can be in contact with it. The collision
+    detection is updated before, so the bounding boxes reflect the current poses but the simulation is not stepped.
+    :param object: The object for which overlapping objects should be found
+    :param world: The BulletWorld if more than one BulletWorld is active
+    :param margin: The distance by which the bounding box of the object is enlarged
+    :return: A list of objects with overlapping bounding boxes, without the given object
+    """
+    world, world_id = _world_and_id(world)
+    p.performCollisionDetection(physicsClientId=world_id)
+    aabb_min, aabb_max = object.get_aabb()
+    overlapping = p.getOverlappingObjects((aabb_min - margin).tolist(), (aabb_max + margin).tolist(),
+                                          physicsClientId=world_id) or []
+    ids = sorted(set(body for body, link in overlapping if body != object.id))
+    # Bodies which were created by calling pybullet directly have no Object
+    return [world.get_object_by_id(id) for id in ids if id in world._objects_by_id]
 
-    return con_points is not ()
 
+def colliding_objects(object, objects=None, world=None, margin=1e-3):
+    """
+    This reasoning query returns the objects which are in collision with the given object. Candidates are found with
+    'overlapping_objects' and only these are checked with the exact distance between the collision shapes, so the
+    cost depends on the number of nearby objects and not on the number of objects in the world. The simulation is not
+    stepped.
+    :param object: The object for which colliding objects should be found
+    :param objects: The objects which should be checked, if None all objects of the world are checked
+    :param world: The BulletWorld if more than one BulletWorld is active
+    :param margin: The maximal distance between two objects for them to count as colliding, the default is small but
+                    not zero so objects which only touch each other are colliding as well
+    :return: A list of objects which are closer to the given object than the margin
+    """
+    return list(contact_points(object, objects, world, margin).keys())
 
-def visible(object, camera_position, world=None):
+
+def visible(object, camera_position, world=None, camera_settings=None):
     """
     This reasoning query checks if an object is visible from a given position. This will be achieved by rendering the object
     alone and counting the visible pixel, then rendering the complete scene and compare the visible pixels with the
@@ -101,33 +593,66 @@ def visible(object, camera_position, world=None):
     :param object: The object for which the visibility should be checked
     :param camera_position: The position of which the camera looks at the object
     :param world: The BulletWorld if more than one BulletWorld is active
+    :param camera_settings: The CameraSettings, if None the settings of the world or the default settings are used
     :return: True if the object is visible from the camera_position False if not
     """
     world, world_id = _world_and_id(world)
-    state = p.saveState()
-    for obj in world.objects:
-        if obj.id is not object.id:
-            # p.removeBody(object.id, physicsClientId=world_id)
-            # Hot fix until I come up with something better
-            p.resetBasePositionAndOrientation(obj.id, [100, 100, 100], [0, 0, 0, 1], world_id)
-
-    seg_mask = _get_seg_mask_for_target(camera_position, object.get_position())
-    flat_list = list(itertools.chain.from_iterable(seg_mask))
-    max_pixel = sum(list(map(lambda x: 1 if x == object.id else 0, flat_list)))
-    p.restoreState(state)
+    settings = _camera_settings(camera_settings, world)
+    max_pixel = np.count_nonzero(_get_solo_masks([object], camera_position, world, world_id, settings)[0])
 
-    seg_mask = _get_seg_mask_for_target(camera_position, object.get_position())
-    flat_list = list(itertools.chain.from_iterable(seg_mask))
-    real_pixel = sum(list(map(lambda x: 1 if x == object.id else 0, flat_list)))
+    seg_mask = _get_seg_mask_for_target(camera_position, object.get_position(), world_id, settings, [object])
+    real_pixel = np.count_nonzero(seg_mask == object.id)
 
     if max_pixel == 0:
         # Object is not visible
-        raise False
+        return False
 
-    return real_pixel / max_pixel > 0.8 > 0
+    return bool(real_pixel / max_pixel > 0.8)
 
 
-def occluding(object, camera_position, world=None):
+def visible_objects(camera_position, objects, target_position=None, world=None, threshold=0.8, camera_settings=None):
+    """
+    This reasoning query checks for many objects at once which of them are visible from a given position. This works
+    like 'visible' but the complete scene is rendered only once and the pixels of all objects are counted in this
+    segmentation mask at once. The pixels every object covers if it is rendered alone are rendered with the camera
+    pointing at the object itself, like in 'visible', and transferred into the image of the complete scene. They are
+    cached for the camera position and the pose of the object, so an object only has to be rendered alone again if it
+    or the camera moved and not if another object moved.
+    Objects which are farther away from the camera than the far plane are sorted out with the spatial index of the
+    world.
+    :param camera_position: The position of which the camera looks at the objects
+    :param objects: The objects for which the visibility should be checked
+    :param target_position: The position at which the camera looks, if None the center of the objects is used
+    :param world: The BulletWorld if more than one BulletWorld is active
+    :param threshold: The fraction of the pixels of an object which have to be visible in the complete scene
+    :param camera_settings: The CameraSettings, if None the settings of the world or the default settings are used
+    :return: A list of the visible objects in the same order as the given objects
+    """
+    world, world_id = _world_and_id(world)
+    settings = _camera_settings(camera_settings, world)
+    if not objects:
+        return []
+    if target_position is None:
+        target_position = world.get_positions_and_orientations(objects)[0].mean(axis=0).tolist()
+    in_range = set(world.spatial_index.query_radius(camera_position, settings.far))
+    objects = [obj for obj in objects if obj in in_range]
+    if not objects:
+        return []
+    ids = list(map(lambda obj: obj.id, objects))
+
+    solo_masks = _get_solo_masks(objects, camera_position, world, world_id, settings)
+    max_pixel = np.array([np.count_nonzero(_reproject_mask(mask, camera_position, obj.get_position(), target_position,
+                                                           settings))
+                          for obj, mask in zip(objects, solo_masks)])
+
+    seg_mask = _get_seg_mask_for_target(camera_position, target_position, world_id, settings, objects)
+    real_pixel = _pixel_counts(seg_mask, ids)
+
+    visible = (max_pixel > 0) & (real_pixel > threshold * max_pixel)
+    return [obj for obj, vis in zip(objects, visible) if vis]
+
+
+def occluding(object, camera_position, world=None, camera_settings=None):
     """
     This reasoning query lists the objects which are occluding a given object. This works similar to 'visible'.
     First the object alone will be rendered and the position of the pixels of the object in the picture will be saved.
@@ -136,31 +661,17 @@ def occluding(object, camera_position, world=None):
     :param object: The object for which occluding should be checked
     :param camera_position: The position from which the camera looks at the object
     :param world: The BulletWorld if more than one BulletWorld is active
+    :param camera_settings: The CameraSettings, if None the settings of the world or the default settings are used
     :return: A list of occluding objects
     """
     world, world_id = _world_and_id(world)
-    state = p.saveState()
-    for obj in world.objects:
-        if obj.id is not object.id:
-            # p.removeBody(object.id, physicsClientId=world_id)
-            # Hot fix until I come up with something better
-            p.resetBasePositionAndOrientation(obj.id, [100, 100, 100], [0, 0, 0, 1], world_id)
-
-    seg_mask = _get_seg_mask_for_target(camera_position, object.get_position())
-    pixels = []
-    for i in range(0, 256):
-        for j in range(0, 256):
-            if seg_mask[i][j] == object.id:
-                pixels.append((i, j))
-    p.restoreState(state)
+    settings = _camera_settings(camera_settings, world)
+    pixels = _get_solo_masks([object], camera_position, world, world_id, settings)[0]
 
-    occluding = []
-    seg_mask = _get_seg_mask_for_target(camera_position, object.get_position())
-    for c in pixels:
-        if not seg_mask[c[0]][c[1]] == object.id:
-            occluding.append(seg_mask[c[0]][c[1]])
+    seg_mask = _get_seg_mask_for_target(camera_position, object.get_position(), world_id, settings, [object])
+    occluding = seg_mask[pixels & (seg_mask != object.id) & (seg_mask >= 0)]
 
-    return list(set(map(lambda x: world.get_object_by_id(x), occluding)))
+    return list(map(lambda x: world.get_object_by_id(x), np.unique(occluding).tolist()))
 
 
 def reachable_object(object, robot, gripper_name, world=None, threshold=0.01):
@@ -179,11 +690,27 @@ def reachable_object(object, robot, gripper_name, world=None, threshold=0.01):
     return reachable_pose(object.get_position(), robot, gripper_name, world, threshold)
 
 
+_reachability_databases = []
+
+
+def register_reachability_database(database):
+    """
+    Registers a precomputed ReachabilityDatabase, see the module reachability. Afterwards 'reachable_pose' looks up
+    positions in it first if the robot, the end effector, the threshold and the joint states of the robot match the
+    database. More than one database can be registered for the same robot, e.g. for different torso heights.
+    :param database: The ReachabilityDatabase
+    """
+    _reachability_databases.append(database)
+
+
 def reachable_pose(pose, robot, gripper_name, world=None, threshold=0.01):
     """
     This reasoning query checks if the robot can reach a given position. To determine this the inverse kinematics are
     calculated and applied. Afterwards the distance between the position and the given end effector is calculated, if
     it is smaller than the threshold the reasoning query returns True, if not it returns False.
+    If a registered ReachabilityDatabase matches the robot, its joint states, the end effector and the threshold, the
+    position is looked up there first and the inverse kinematics are only calculated for positions in borderline cells
+    or outside of the database.
     :param pose: The position for that reachability should be checked
     :param robot: The robot that should reach for the position
     :param gripper_name: The name of the end effector
@@ -193,20 +720,82 @@ def reachable_pose(pose, robot, gripper_name, world=None, threshold=0.01):
     to the target position, False in every other case to the target position, False in every other case
     """
     world, world_id = _world_and_id(world)
-    state = p.saveState()
-    inv = p.calculateInverseKinematics(robot.id, robot.get_link_id(gripper_name), pose,
-                                       maxNumIterations=100, physicsClientId=world_id)
-    for i in range(p.getNumJoints(robot.id)):
-        qIndex = p.getJointInfo(robot.id, i)[3]
-        if qIndex > -1:
-            p.resetJointState(robot.id, i, inv[qIndex-7])
-
-    newp = p.getLinkState(robot.id, robot.get_link_id(gripper_name))[4]
-    diff = [pose[0] - newp[0], pose[1] - newp[1],  pose[2] - newp[2]]
-    p.restoreState(state)
+    for database in _reachability_databases:
+        if database.matches(robot, gripper_name, threshold):
+            reachable = database.lookup(robot, pose)
+            if reachable is not None:
+                return reachable
+            break
+
+    with world.snapshots.scoped(physics_only=True):
+        inv = calculate_ik(robot, gripper_name, pose, world)
+        robot._reset_joint_states(None, inv)
+
+        newp = p.getLinkState(robot.id, robot.get_link_id(gripper_name), physicsClientId=world_id)[4]
+        diff = [pose[0] - newp[0], pose[1] - newp[1],  pose[2] - newp[2]]
     return np.sqrt(diff[0] ** 2 + diff[1] ** 2 + diff[2] ** 2) < threshold
 
 
+# The results of 'reachability_map' for the pose and the joint states of the robot and the query positions
+_reachability_maps = _LRUCache(maxsize=64)
+
+
+def reachability_map(robot, gripper_name, poses, world=None, threshold=0.01, max_iterations=100, store=True):
+    """
+    This reasoning query checks for many positions at once if the robot can reach them. This works like
+    'reachable_pose', but the state of the world is saved and restored only once. The positions are visited in sorted
+    order and the inverse kinematics for every position starts from the solution of the previous position, which is
+    close by. If this warm start fails the solver is started again from the current joint states of the robot.
+    The results are stored for the pose of the robot base and the joint states of the robot, which are the rest pose of
+    the solver, so asking again for the same positions is answered without calculating the inverse kinematics. Only
+    the results of the most recently used position grids are kept.
+    The warm start is done by keeping the joint states of the previous solution, the 'currentPositions' parameter of
+    pybullet is not used since the solver does not iterate when it is given.
+    :param robot: The robot that should reach for the positions
+    :param gripper_name: The name of the end effector
+    :param poses: The positions for which reachability should be checked as list or Nx3 array
+    :param world: The BulletWorld in which the reasoning query should operate
+    :param threshold: The threshold between the end effector and the positions
+    :param max_iterations: The maximal number of iterations of the solver
+    :param store: If the results should be stored for the pose and the joint states of the robot
+    :return: A NumPy boolean array which is True for every reachable position and a NumPy array with the distances
+                between the end effector and the positions, both in the order of the given positions
+    """
+    world, world_id = _world_and_id(world)
+    poses = np.asarray(poses, dtype=float).reshape(-1, 3)
+    link_id = robot.get_link_id(gripper_name)
+    rest_pose = robot.get_joint_states()
+    key = (world_id, robot.id, link_id, threshold, max_iterations, _quantize(robot.get_position()),
+           _quantize(robot.get_orientation()), _quantize(rest_pose), poses.tobytes())
+    stored = _reachability_maps.get(key) if store else None
+    if stored is not None:
+        return stored[0].copy(), stored[1].copy()
+
+    def solve(pose):
+        robot._reset_joint_states(None, p.calculateInverseKinematics(robot.id, link_id, pose.tolist(),
+                                                                     maxNumIterations=max_iterations,
+                                                                     physicsClientId=world_id))
+        position = p.getLinkState(robot.id, link_id, computeForwardKinematics=1, physicsClientId=world_id)[4]
+        return np.linalg.norm(pose - np.array(position))
+
+    distances = np.empty(len(poses))
+    warm = False
+    with world.snapshots.scoped(physics_only=True):
+        for i in np.lexsort(poses.T[::-1]):
+            distances[i] = solve(poses[i])
+            if distances[i] >= threshold and warm:
+                robot._reset_joint_states(None, rest_pose)
+                distances[i] = solve(poses[i])
+            warm = distances[i] < threshold
+            if not warm:
+                robot._reset_joint_states(None, rest_pose)
+
+    reachable = distances < threshold
+    if store:
+        _reachability_maps.put(key, (reachable.copy(), distances.copy()))
+    return reachable, distances
+
+
 def blocking(object, robot, gripper_name, world=None):
     """
     This reasoning query checks if any objects are blocking an other object when an robot tries to pick it. This works
@@ -219,21 +808,11 @@ def blocking(object, robot, gripper_name, world=None):
     :return: A list of objects the robot is in collision with when reaching for the specified object
     """
     world, world_id = _world_and_id(world)
-    state = p.saveState()
-    inv = p.calculateInverseKinematics(robot.id, robot.get_link_id(gripper_name), object.get_pose(),
-                                       maxNumIterations=100, physicsClientId=world_id)
-    for i in range(0, p.getNumJoints(robot.id)):
-        qIndex = p.getJointInfo(robot.id, i)[3]
-        if qIndex > -1:
-            p.resetJointState(robot.id, i, inv[qIndex-7])
-
-    block = []
-    for obj in world.objects:
-        if obj == object:
-            continue
-        if contact(robot, obj, world):
-            block.append(obj)
-    p.restoreState(state)
+    with world.snapshots.scoped(physics_only=True):
+        inv = calculate_ik(robot, gripper_name, object.get_pose(), world)
+        robot._reset_joint_states(None, inv)
+
+        block = [obj for obj in colliding_objects(robot, world=world) if obj != object]
     return block
 
 
@@ -247,5 +826,42 @@ def supporting(object1, object2, world=None):
     :return: True if the second object is in contact with the first one and the second one ist above the first False else
     """
     world, world_id = _world_and_id(world)
-    return contact(object1, object2, world) and object2.getposition()[2] > object1.get_position()[2]
+    return contact(object1, object2, world) and object2.get_position()[2] > object1.get_position()[2]
+
+
+def support_graph(world=None, objects=None, margin=1e-3, min_normal_z=0.7):
+    """
+    This reasoning query computes all support relations between the objects of a scene at once. Pairs of objects with
+    overlapping bounding boxes are found with the spatial index of the world and the closest points of every pair are
+    calculated once. An object supports an other object if they are in contact, the contact normal points upwards from
+    the supporting object and the supported object is higher than the supporting one. The simulation is not stepped.
+    :param world: The BulletWorld if more than one BulletWorld is active
+    :param objects: The objects which should be considered, if None all objects of the world are used
+    :param margin: The maximal distance between two objects for them to be in contact
+    :param min_normal_z: The minimal z component of the mean contact normal, contacts with a smaller z component
+                            are side contacts and do not count as support
+    :return: A dictionary from every object to the list of objects it supports, e.g. graph[tray] are the objects on
+                the tray
+    """
+    world, world_id = _world_and_id(world)
+    objects = world.objects if objects is None else objects
+    graph = {obj: [] for obj in objects}
+    aabbs = {obj: obj.get_aabb() for obj in objects}
+    for object_a in objects:
+        aabb_min, aabb_max = aabbs[object_a]
+        for object_b in world.spatial_index.query_box(aabb_min - margin, aabb_max + margin):
+            if object_b not in graph or object_b.id <= object_a.id:
+                continue
+            points = p.getClosestPoints(object_a.id, object_b.id, margin, physicsClientId=world_id)
+            if not points:
+                continue
+            # The normals point from object_b to object_a
+            normal_z = np.mean([point[7][2] for point in points])
+            center_a = (aabbs[object_a][0][2] + aabbs[object_a][1][2]) / 2
+            center_b = (aabbs[object_b][0][2] + aabbs[object_b][1][2]) / 2
+            if normal_z >= min_normal_z and center_a > center_b:
+                graph[object_b].append(object_a)
+            elif normal_z <= -min_normal_z and center_b > center_a:
+                graph[object_a].append(object_b)
+    return graph
 
@@ -0,0 +1,189 @@
+"""Implementation of precomputed reachability databases
+
+The reachability of a robot relative to its base barely changes, so it can be calculated once, stored on disk and used
+by 'reachable_pose' of bullet_world_reasoning to answer most queries without calculating the inverse kinematics.
+A database can be created with the command line tool of this module, e.g.:
+
+python -m pycram.reachability resources/pr2.urdf r_gripper_tool_frame pr2_right
+
+Classes:
+ReachabilityDatabase -- A voxel grid which stores for an end effector of a robot which positions are reachable
+
+Functions:
+main -- the command line tool to create a database.
+"""
+
+import argparse
+import json
+import numpy as np
+import pybullet as p
+from . import bullet_world_reasoning as btr
+from .bullet_world import BulletWorld, Object
+
+UNREACHABLE = 0
+BORDERLINE = 1
+REACHABLE = 2
+
+
+class ReachabilityDatabase:
+    """
+    A ReachabilityDatabase is a voxel grid in the frame of the robot base. Every cell is either UNREACHABLE, REACHABLE
+    or BORDERLINE, borderline cells are cells which have neighbours with a different reachability and have to be checked
+    with the inverse kinematics. The grid is stored as .npy file and loaded memory mapped, the meta data is stored in a
+    .json file next to it.
+    The reachability depends on the threshold and on the joint states of the robot, which are the start of the inverse
+    kinematics, so a database only answers queries with the threshold and the joint states it was built with, see
+    'matches'.
+    """
+
+    def __init__(self, grid, origin, resolution, robot_path, gripper_name, threshold, joint_names, joint_states):
+        """
+        :param grid: The voxel grid as 3 dimensional NumPy array of UNREACHABLE, BORDERLINE and REACHABLE
+        :param origin: The center of the first cell in the frame of the robot base
+        :param resolution: The edge length of the cells
+        :param robot_path: The path of the URDF of the robot
+        :param gripper_name: The name of the end effector
+        :param threshold: The threshold between the end effector and a position the database was built with
+        :param joint_names: The names of the movable joints of the robot
+        :param joint_states: The states of the movable joints the database was built with
+        """
+        self.grid = grid
+        self.origin = np.asarray(origin, dtype=float)
+        self.resolution = resolution
+        self.robot_path = robot_path
+        self.gripper_name = gripper_name
+        self.threshold = threshold
+        self.joint_names = list(joint_names)
+        self.joint_states = np.asarray(joint_states, dtype=float)
+
+    @staticmethod
+    def build(robot, gripper_name, minimum, maximum, resolution=0.05, world=None, threshold=0.01):
+        """
+        Samples the workspace of an end effector by checking the reachability of the center of every cell with
+        'reachability_map'. The current joint states of the robot are used as start for the inverse kinematics.
+        :param robot: The robot for which the database should be created
+        :param gripper_name: The name of the end effector
+        :param minimum: The minimal x,y,z coordinates of the workspace in the frame of the robot base
+        :param maximum: The maximal x,y,z coordinates of the workspace in the frame of the robot base
+        :param resolution: The edge length of the cells
+        :param world: The BulletWorld in which the robot was spawned
+        :param threshold: The threshold between the end effector and a position for the position to be reachable
+        :return: The new ReachabilityDatabase
+        """
+        minimum = np.asarray(minimum, dtype=float)
+        shape = np.maximum(np.ceil((np.asarray(maximum, dtype=float) - minimum) / resolution), 1).astype(int)
+        origin = minimum + resolution / 2
+        indices = np.indices(shape).reshape(3, -1).T
+        local = origin + indices * resolution
+        world_positions = _base_to_world(robot, local)
+        reachable = btr.reachability_map(robot, gripper_name, world_positions, world, threshold,
+                                         store=False)[0].reshape(shape)
+
+        grid = np.where(reachable, REACHABLE, UNREACHABLE).astype(np.uint8)
+        # Cells with a neighbour of different reachability are not reliable
+        for axis in range(3):
+            differs = np.diff(reachable, axis=axis)
+            lower = [slice(None)] * 3
+            upper = [slice(None)] * 3
+            lower[axis] = slice(None, -1)
+            upper[axis] = slice(1, None)
+            grid[tuple(lower)][differs] = BORDERLINE
+            grid[tuple(upper)][differs] = BORDERLINE
+        joint_names = [robot.joint_names[i] for i in robot.movable_joints]
+        return ReachabilityDatabase(grid, origin, resolution, robot.path, gripper_name, threshold, joint_names,
+                                    robot.get_joint_states())
+
+    def save(self, path):
+        """
+        Saves the database as path.npy and path.json.
+        :param path: The path of the files without extension
+        """
+        np.save(path + ".npy", np.asarray(self.grid))
+        with open(path + ".json", "w", encoding="utf-8") as file:
+            json.dump({'origin': self.origin.tolist(), 'resolution': self.resolution, 'robot_path': self.robot_path,
+                       'gripper_name': self.gripper_name, 'threshold': self.threshold,
+                       'joint_names': self.joint_names, 'joint_states': self.joint_states.tolist()}, file)
+
+    @staticmethod
+    def load(path):
+        """
+        Loads a database which was saved with 'save', the voxel grid is memory mapped and not read into memory.
+        :param path: The path of the files without extension
+        :return: The loaded ReachabilityDatabase
+        """
+        with open(path + ".json", encoding="utf-8") as file:
+            meta = json.load(file)
+        grid = np.load(path + ".npy", mmap_mode='r')
+        return ReachabilityDatabase(grid, meta['origin'], meta['resolution'], meta['robot_path'], meta['gripper_name'],
+                                    meta['threshold'], meta['joint_names'], meta['joint_states'])
+
+    def matches(self, robot, gripper_name, threshold, tolerance=1e-3):
+        """
+        Checks if this database can answer a query, this is the case if the robot was spawned from the same URDF, has
+        the same movable joints in the same states as the robot the database was built with and the query uses the
+        same end effector and threshold.
+        :param robot: The robot of the query
+        :param gripper_name: The name of the end effector of the query
+        :param threshold: The threshold of the query
+        :param tolerance: The maximal difference of a joint state which counts as the same state
+        :return: True if the database can be used for the query, False else
+        """
+        if robot.path != self.robot_path or gripper_name != self.gripper_name or \
+                not np.isclose(threshold, self.threshold, rtol=0, atol=1e-9):
+            return False
+        if [robot.joint_names[i] for i in robot.movable_joints] != self.joint_names:
+            return False
+        return bool(np.allclose(robot.get_joint_states(), self.joint_states, rtol=0, atol=tolerance))
+
+    def lookup(self, robot, position):
+        """
+        Looks up if a position in world coordinates is reachable for the robot.
+        :param robot: The robot, 'matches' has to be True for it
+        :param position: The position in world coordinates
+        :return: True if the position is reachable, False if not, or None if the position is in a borderline cell or
+                    outside of the grid
+        """
+        index = np.round((_world_to_base(robot, position) - self.origin) / self.resolution).astype(int)
+        if np.any(index < 0) or np.any(index >= self.grid.shape):
+            return None
+        cell = self.grid[tuple(index)]
+        if cell == BORDERLINE:
+            return None
+        return bool(cell == REACHABLE)
+
+
+def _base_to_world(robot, positions):
+    rotation = np.reshape(p.getMatrixFromQuaternion(robot.get_orientation()), (3, 3))
+    return positions @ rotation.T + np.array(robot.get_position())
+
+
+def _world_to_base(robot, position):
+    rotation = np.reshape(p.getMatrixFromQuaternion(robot.get_orientation()), (3, 3))
+    return (np.asarray(position, dtype=float) - np.array(robot.get_position())) @ rotation
+
+
+def main(args=None):
+    """
+    The command line tool which spawns a robot in a non-graphical BulletWorld, builds a ReachabilityDatabase for one
+    end effector and saves it.
+    """
+    parser = argparse.ArgumentParser(description="Create a reachability database for an end effector of a robot.")
+    parser.add_argument("urdf", help="the URDF of the robot")
+    parser.add_argument("gripper", help="the name of the end effector link")
+    parser.add_argument("output", help="the path of the database without extension")
+    parser.add_argument("--min", type=float, nargs=3, default=[-1.5, -1.5, 0], help="minimal x y z in the base frame")
+    parser.add_argument("--max", type=float, nargs=3, default=[1.5, 1.5, 2], help="maximal x y z in the base frame")
+    parser.add_argument("--resolution", type=float, default=0.05, help="the edge length of the cells")
+    parser.add_argument("--threshold", type=float, default=0.01, help="the allowed distance to the target")
+    args = parser.parse_args(args)
+
+    world = BulletWorld("DIRECT")
+    robot = Object("robot", "robot", args.urdf, world=world)
+    database = ReachabilityDatabase.build(robot, args.gripper, args.min, args.max, args.resolution, world,
+                                          args.threshold)
+    database.save(args.output)
+    world.exit()
+
+
+if __name__ == "__main__":
+    main()
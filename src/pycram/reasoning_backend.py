@@ -0,0 +1,251 @@
+"""Implementation of a process based execution backend for reasoning queries
+
+Classes:
+ProcessPoolBackend -- Executes reasoning queries in worker processes which mirror a BulletWorld
+ObjectReference -- A picklable reference to an Object which is used to transfer objects between processes
+"""
+
+import itertools
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import Future
+from multiprocessing.reduction import ForkingPickler
+from .bullet_world import Object, _world_and_id
+from .bullet_world_pool import ShadowWorld, WorldObserver
+
+
+class ObjectReference:
+    """
+    This class references an Object of the BulletWorld in the main process. It holds everything a worker process needs
+    to spawn the object on its own and is equal to every other reference to the same object. Every reference gets a
+    new generation, so the reference to a removed object is not equal to the reference to a new object which got the
+    same pybullet id.
+    """
+
+    _generations = itertools.count()
+
+    def __init__(self, object):
+        self.id = object.id
+        self.generation = next(ObjectReference._generations)
+        self.name = object.name
+        self.type = object.type
+        self.path = object.path
+        self.color = object.color
+
+    def __eq__(self, other):
+        return isinstance(other, ObjectReference) and other.id == self.id and other.generation == self.generation
+
+    def __hash__(self):
+        return hash((self.id, self.generation))
+
+
+class ProcessPoolBackend:
+    """
+    The ProcessPoolBackend executes reasoning queries in worker processes. Every worker has its own DIRECT BulletWorld
+    which mirrors the given world, so CPU heavy queries like stepping the simulation or calculating the inverse
+    kinematics run in parallel. The workers load the URDFs of the objects once and afterwards only the poses, joint
+    states and attachments which changed since the last query are sent to them.
+
+    Queries have to be functions which can be imported by the workers and accept the BulletWorld in which they should
+    operate as keyword argument 'world', like 'stable', 'reachable_pose', 'visible' or 'contact' of
+    bullet_world_reasoning. Objects in the arguments and results are translated between the processes automatically.
+    """
+
+    def __init__(self, processes=2, world=None, start_method=None):
+        """
+        Starts the worker processes. The workers spawn the objects of the world when they receive their first query.
+        :param processes: The number of worker processes
+        :param world: The BulletWorld which should be mirrored, if None the 'current_bullet_world' is used
+        :param start_method: The multiprocessing start method for the workers, if None the default of the platform is
+                                used. Note that "spawn" and "forkserver" import the main module again in every worker.
+        """
+        self.world, _ = _world_and_id(world)
+        self._observer = WorldObserver(self.world)
+        self._jobs = queue.Queue()
+        self._references = {}
+        self._objects = {}
+        self._snapshot = None
+        self._workers = []
+        context = multiprocessing.get_context(start_method)
+        # All workers are started before the dispatcher threads, so no worker is forked while they are running
+        for i in range(processes):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target=_worker, args=(worker_connection,), daemon=True)
+            process.start()
+            self._workers.append(_Dispatcher(process, connection, self._jobs, self.world, self._objects))
+        for dispatcher in self._workers:
+            dispatcher.start()
+
+    def submit(self, query, *args, **kwargs):
+        """
+        Submits a reasoning query to the worker processes. The query will be answered for the state the world had when
+        it was submitted.
+        :param query: The reasoning query, e.g. bullet_world_reasoning.stable
+        :param args: The arguments for the reasoning query
+        :param kwargs: The keyword arguments for the reasoning query
+        :return: A concurrent.futures.Future which holds the result of the query
+        """
+        future = Future()
+        snapshot = self._reference_snapshot()
+        args = self._to_reference(args)
+        kwargs = {key: self._to_reference(value) for key, value in kwargs.items()}
+        self._jobs.put((snapshot, query, args, kwargs, future))
+        return future
+
+    def submit_batch(self, queries):
+        """
+        Submits many reasoning queries at once, all of them will be answered for the current state of the world.
+        :param queries: A list of tuples of a query, a list of arguments and optionally a dictionary of keyword
+                        arguments
+        :return: A list of concurrent.futures.Future in the same order as the queries
+        """
+        return [self.submit(query[0], *query[1], **(query[2] if len(query) > 2 else {})) for query in queries]
+
+    def exit(self):
+        """
+        Waits until all submitted queries are answered and stops the worker processes.
+        """
+        for worker in self._workers:
+            self._jobs.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._observer.exit()
+
+    def _reference_snapshot(self):
+        """
+        Creates a snapshot of the world in which all objects are replaced by references. The snapshot is only created
+        again if the snapshot of the WorldObserver changed, then the references to removed objects are dropped.
+        """
+        snapshot = self._observer.capture()
+        if self._snapshot is None or self._snapshot[0] is not snapshot:
+            states, attachments, gravity = snapshot
+            for obj in [obj for obj in self._references if obj not in states]:
+                del self._objects[self._references.pop(obj)]
+            states = {self._to_reference(obj): state for obj, state in states.items()}
+            attachments = frozenset((self._to_reference(parent), self._to_reference(child), parent_link, child_link)
+                                    for parent, child, parent_link, child_link in attachments)
+            self._snapshot = snapshot, (states, attachments, gravity)
+        return self._snapshot[1]
+
+    def _to_reference(self, value):
+        if isinstance(value, (list, tuple)):
+            return type(value)(map(self._to_reference, value))
+        if isinstance(value, dict):
+            return {self._to_reference(key): self._to_reference(item) for key, item in value.items()}
+        if isinstance(value, Object):
+            if value not in self._references:
+                self._references[value] = ObjectReference(value)
+                self._objects[self._references[value]] = value
+            return self._references[value]
+        return value
+
+
+class _Dispatcher(threading.Thread):
+    """
+    This class is for internal use only. It takes queries from the job queue, sends them together with the changes of
+    the world to its worker process and sets the result of the future. Errors which only concern a single query, like
+    arguments or results which can not be pickled or objects which were removed meanwhile, are set as exception of its
+    future and the dispatcher continues with the next query.
+    """
+
+    def __init__(self, process, connection, jobs, world, objects):
+        threading.Thread.__init__(self, daemon=True)
+        self.process = process
+        self.connection = connection
+        self.jobs = jobs
+        self.world = world
+        self.objects = objects
+        self._states = {}
+        self._attachments = frozenset()
+        self._gravity = None
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.connection.send(None)
+                self.process.join()
+                return
+            snapshot, query, args, kwargs, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                # Pickled before sending, so a query which can not be pickled does not change the state of the worker
+                message = ForkingPickler.dumps((self._changes(snapshot), query, args, kwargs))
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            self._states, self._attachments, self._gravity = snapshot
+            try:
+                self.connection.send_bytes(message)
+                data = self.connection.recv_bytes()
+            except (EOFError, OSError) as e:
+                future.set_exception(e)
+                continue
+            try:
+                success, result = ForkingPickler.loads(data)
+                if success:
+                    future.set_result(self._to_object(result))
+                else:
+                    future.set_exception(result)
+            except Exception as e:
+                future.set_exception(e)
+
+    def _changes(self, snapshot):
+        """
+        Computes the changes between the given snapshot and the last snapshot sent to the worker.
+        :return: A tuple of the changed states, the removed objects, the attachments and the gravity
+        """
+        states, attachments, gravity = snapshot
+        changed = {ref: state for ref, state in states.items() if self._states.get(ref) != state}
+        removed = [ref for ref in self._states if ref not in states]
+        attachments_changed = attachments != self._attachments
+        gravity_changed = gravity != self._gravity
+        return changed, removed, attachments if attachments_changed else None, gravity if gravity_changed else None
+
+    def _to_object(self, value):
+        if isinstance(value, (list, tuple)):
+            return type(value)(map(self._to_object, value))
+        if isinstance(value, dict):
+            return {self._to_object(key): self._to_object(item) for key, item in value.items()}
+        if isinstance(value, ObjectReference):
+            obj = self.objects.get(value)
+            if obj is None or self.world._objects_by_id.get(obj.id) is not obj:
+                raise KeyError("The object {} was removed from the world".format(value.name))
+            return obj
+        return value
+
+
+def _worker(connection):
+    """
+    The main function of the worker processes. It creates a shadow world, applies the changes it receives and answers
+    the queries until it receives None.
+    :param connection: The connection to the main process
+    """
+    shadow = ShadowWorld()
+    states, attachments, gravity = {}, frozenset(), (0, 0, 0)
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        (changed, removed, new_attachments, new_gravity), query, args, kwargs = message
+        states.update(changed)
+        for ref in removed:
+            del states[ref]
+        attachments = new_attachments if new_attachments is not None else attachments
+        gravity = new_gravity if new_gravity is not None else gravity
+        try:
+            shadow.sync((states, attachments, gravity))
+            kwargs = {key: shadow.to_shadow(value) for key, value in kwargs.items()}
+            kwargs['world'] = shadow.shadow
+            result = query(*shadow.to_shadow(args), **kwargs)
+            reply = True, shadow.to_original(result)
+        except Exception as e:
+            reply = False, e
+        try:
+            data = ForkingPickler.dumps(reply)
+        except Exception as e:
+            data = ForkingPickler.dumps((False, RuntimeError("The reply could not be pickled: {!r}".format(e))))
+        connection.send_bytes(data)
+    shadow.exit()
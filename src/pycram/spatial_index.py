@@ -0,0 +1,233 @@
+"""Implementation of a spatial index for the objects of a BulletWorld
+
+Classes:
+SpatialIndex -- A uniform grid of the axis aligned bounding boxes of all objects and links of a BulletWorld
+"""
+
+import pybullet as p
+import numpy as np
+import threading
+
+
+class SpatialIndex:
+    """
+    The SpatialIndex stores the axis aligned bounding boxes of the base and every link of all objects of a BulletWorld
+    in a uniform grid, so queries for objects near a position, inside a box or along a ray only have to look at the
+    cells they touch instead of all objects. Bounding boxes which would cover more than 'max_cells' cells, like the one
+    of a floor plane, are not put into the grid but checked by every query.
+    Every BulletWorld maintains its own index as 'spatial_index'. Objects are added and removed with the world and
+    marked as changed by the manipulation event, their bounding boxes are only read again at the next query. If the
+    simulation is changed by calling pybullet directly, 'update' has to be called for the changed objects.
+    The manipulation event may be fired from the thread of 'simulate_async', so the changed objects are guarded by a
+    lock.
+    """
+
+    def __init__(self, world, cell_size=0.5, max_cells=512):
+        """
+        :param world: The BulletWorld whose objects should be indexed
+        :param cell_size: The edge length of the cells of the grid
+        :param max_cells: The maximal number of cells a bounding box may cover to be put into the grid
+        """
+        self.world = world
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        self._cells = {}
+        self._large = set()
+        self._entries = {}
+        self._links = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        world.manipulation_event.add(self._on_manipulation)
+
+    def add(self, object):
+        """
+        Adds an object to the index, its bounding boxes are read at the next query.
+        :param object: The object which should be added
+        """
+        with self._lock:
+            self._links[object] = [-1] + list(object.links.values())
+            self._dirty.add(object)
+
+    def remove(self, object):
+        """
+        Removes an object and all of its links from the index.
+        :param object: The object which should be removed
+        """
+        with self._lock:
+            for link_id in self._links.pop(object, []):
+                self._remove_entry((object, link_id))
+            self._dirty.discard(object)
+
+    def update(self, object=None):
+        """
+        Marks an object as changed, so its bounding boxes are read again at the next query.
+        :param object: The object which changed, if None all objects are marked as changed
+        """
+        with self._lock:
+            self._dirty.update(self._links.keys() if object is None else [object])
+
+    def query_box(self, aabb_min, aabb_max, links=False):
+        """
+        Returns all objects whose base or links overlap the given box.
+        :param aabb_min: The minimal x,y,z coordinates of the box
+        :param aabb_max: The maximal x,y,z coordinates of the box
+        :param links: If True tuples of the object and the link id are returned instead of objects, the base has the
+                        link id -1
+        :return: A list of the objects or tuples of objects and link ids, sorted by the id of the objects
+        """
+        aabb_min = np.asarray(aabb_min, dtype=float)
+        aabb_max = np.asarray(aabb_max, dtype=float)
+        found = [key for key in self._candidates(aabb_min, aabb_max)
+                 if np.all(self._entries[key][0] <= aabb_max) and np.all(self._entries[key][1] >= aabb_min)]
+        return self._result(found, links)
+
+    def query_radius(self, center, radius, links=False):
+        """
+        Returns all objects whose base or links have a bounding box which is closer to the center than the radius.
+        :param center: The x,y,z coordinates of the center
+        :param radius: The radius around the center
+        :param links: If True tuples of the object and the link id are returned instead of objects
+        :return: A list of the objects or tuples of objects and link ids, sorted by the id of the objects
+        """
+        center = np.asarray(center, dtype=float)
+        found = []
+        for key in self._candidates(center - radius, center + radius):
+            aabb_min, aabb_max = self._entries[key][:2]
+            if np.linalg.norm(center - np.clip(center, aabb_min, aabb_max)) <= radius:
+                found.append(key)
+        return self._result(found, links)
+
+    def query_ray(self, ray_from, ray_to, links=False):
+        """
+        Returns all objects whose base or links have a bounding box which is hit by the ray between the two positions.
+        Only the cells along the ray are visited.
+        :param ray_from: The start of the ray
+        :param ray_to: The end of the ray
+        :param links: If True tuples of the object and the link id are returned instead of objects
+        :return: A list of the objects or tuples of objects and link ids, sorted by the distance of the hit from the
+                    start of the ray
+        """
+        self._refresh()
+        ray_from = np.asarray(ray_from, dtype=float)
+        direction = np.asarray(ray_to, dtype=float) - ray_from
+        hits = {key: _ray_box_intersection(ray_from, direction, *self._entries[key][:2]) for key in self._large}
+        for cell in self._ray_cells(ray_from, direction):
+            for key in self._cells.get(cell, ()):
+                if key not in hits:
+                    hits[key] = _ray_box_intersection(ray_from, direction, *self._entries[key][:2])
+        found = sorted(filter(lambda key: hits[key] is not None, hits), key=lambda key: (hits[key], key[0].id, key[1]))
+        if links:
+            return found
+        result = []
+        for object, link_id in found:
+            if object not in result:
+                result.append(object)
+        return result
+
+    def _on_manipulation(self, sender, objects):
+        with self._lock:
+            self._dirty.update(filter(lambda obj: obj in self._links, objects))
+
+    def _refresh(self):
+        """
+        Reads the bounding boxes of all changed objects and moves their entries to the cells they overlap now.
+        """
+        with self._lock:
+            for object in self._dirty:
+                for link_id in self._links[object]:
+                    aabb = p.getAABB(object.id, link_id, physicsClientId=self.world.client_id)
+                    self._set_entry((object, link_id), np.array(aabb[0]), np.array(aabb[1]))
+            self._dirty.clear()
+
+    def _set_entry(self, key, aabb_min, aabb_max):
+        cells = self._cell_range(aabb_min, aabb_max)
+        if np.prod(np.array(cells[1]) - np.array(cells[0]) + 1) > self.max_cells:
+            cells = None
+        if key not in self._entries or self._entries[key][2] != cells:
+            self._remove_entry(key)
+            if cells is None:
+                self._large.add(key)
+            else:
+                for cell in _iterate_cells(*cells):
+                    self._cells.setdefault(cell, set()).add(key)
+        self._entries[key] = aabb_min, aabb_max, cells
+
+    def _remove_entry(self, key):
+        if key not in self._entries:
+            return
+        cells = self._entries.pop(key)[2]
+        if cells is None:
+            self._large.discard(key)
+            return
+        for cell in _iterate_cells(*cells):
+            self._cells[cell].discard(key)
+            if not self._cells[cell]:
+                del self._cells[cell]
+
+    def _cell_range(self, aabb_min, aabb_max):
+        return (tuple(np.floor(aabb_min / self.cell_size).astype(int).tolist()),
+                tuple(np.floor(aabb_max / self.cell_size).astype(int).tolist()))
+
+    def _candidates(self, aabb_min, aabb_max):
+        """
+        Returns the keys of all entries in the cells which overlap the given box and of all large entries. If the box
+        covers more cells than are occupied, the occupied cells are filtered instead.
+        """
+        self._refresh()
+        lower, upper = self._cell_range(aabb_min, aabb_max)
+        if np.prod(np.array(upper) - np.array(lower) + 1) > len(self._cells):
+            cells = [cell for cell in self._cells
+                     if all(lower[i] <= cell[i] <= upper[i] for i in range(3))]
+        else:
+            cells = _iterate_cells(lower, upper)
+        candidates = set(self._large)
+        for cell in cells:
+            candidates.update(self._cells.get(cell, ()))
+        return candidates
+
+    def _ray_cells(self, ray_from, direction):
+        """
+        Visits the cells along a ray with a 3D digital differential analyzer.
+        """
+        cell = np.floor(ray_from / self.cell_size).astype(int)
+        end = np.floor((ray_from + direction) / self.cell_size).astype(int)
+        step = np.sign(direction).astype(int)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            next_boundary = (cell + (step > 0)) * self.cell_size
+            t_max = np.where(step != 0, (next_boundary - ray_from) / direction, np.inf)
+            t_delta = np.where(step != 0, self.cell_size / np.abs(direction), np.inf)
+        for i in range(int(np.abs(end - cell).sum()) + 1):
+            yield tuple(cell.tolist())
+            axis = int(np.argmin(t_max))
+            if t_max[axis] > 1:
+                return
+            cell[axis] += step[axis]
+            t_max[axis] += t_delta[axis]
+
+    def _result(self, keys, links):
+        if links:
+            return sorted(keys, key=lambda key: (key[0].id, key[1]))
+        return sorted(set(key[0] for key in keys), key=lambda obj: obj.id)
+
+
+def _iterate_cells(lower, upper):
+    for x in range(lower[0], upper[0] + 1):
+        for y in range(lower[1], upper[1] + 1):
+            for z in range(lower[2], upper[2] + 1):
+                yield x, y, z
+
+
+def _ray_box_intersection(ray_from, direction, aabb_min, aabb_max):
+    """
+    Returns the fraction of the ray at which it enters the box or None if it misses the box.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = (aabb_min - ray_from) / direction
+        t2 = (aabb_max - ray_from) / direction
+    inside = (ray_from >= aabb_min) & (ray_from <= aabb_max)
+    t_near = np.where(direction == 0, np.where(inside, -np.inf, np.inf), np.minimum(t1, t2))
+    t_far = np.where(direction == 0, np.where(inside, np.inf, -np.inf), np.maximum(t1, t2))
+    enter = max(t_near.max(), 0.0)
+    if enter > min(t_far.min(), 1.0):
+        return None
+    return enter
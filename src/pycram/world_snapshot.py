@@ -0,0 +1,205 @@
+"""Implementation of snapshots of the state of a BulletWorld
+
+Classes:
+WorldSnapshot -- A saved state of a BulletWorld to which the world can be reset
+SnapshotDiff -- The differences between two snapshots
+SnapshotManager -- Manages the named and scoped snapshots of a BulletWorld
+"""
+
+import pybullet as p
+import numpy as np
+from contextlib import contextmanager
+
+
+class WorldSnapshot:
+    """
+    A WorldSnapshot is a state of a BulletWorld which was saved with 'save_snapshot' or the SnapshotManager. It holds
+    the id of the state in the physics server, the objects and the attachments the world had at this time and
+    optionally the poses and joint states of all objects, which are needed to compute diffs.
+    Snapshots which only hold the physics state have None as objects and attachments.
+    """
+
+    def __init__(self, state_id, objects, attachments, states=None):
+        """
+        :param state_id: The id of the state returned by saveState
+        :param objects: The list of objects in the world
+        :param attachments: The set of attachments as returned by 'get_attachments'
+        :param states: A dictionary from every object to a tuple of its position, orientation and joint states or None
+        """
+        self.state_id = state_id
+        self.objects = objects
+        self.attachments = attachments
+        self.states = states
+
+
+class SnapshotDiff:
+    """
+    The SnapshotDiff holds which objects differ between two snapshots. The attribute 'moved' is the list of objects
+    whose base pose changed, 'joints' is a dictionary from objects to the names of their joints that changed, 'added'
+    and 'removed' are the objects which only exist in the newer or the older snapshot.
+    """
+
+    def __init__(self, moved, joints, added, removed):
+        self.moved = moved
+        self.joints = joints
+        self.added = added
+        self.removed = removed
+
+    def changed_objects(self):
+        """
+        :return: A list of all objects which exist in both snapshots and whose base pose or joint states changed
+        """
+        return self.moved + [obj for obj in self.joints if obj not in self.moved]
+
+
+class SnapshotManager:
+    """
+    The SnapshotManager of a BulletWorld saves, restores and removes snapshots. Snapshots can be given a name to be
+    restored later, unnamed snapshots belong to the caller who should remove them once they are not needed anymore, or
+    use 'scoped' which does this automatically. Every BulletWorld has its own manager as 'snapshots'.
+    """
+
+    def __init__(self, world):
+        """
+        :param world: The BulletWorld whose snapshots are managed
+        """
+        self.world = world
+        self._named = {}
+
+    def save(self, name=None, record=True):
+        """
+        Saves the current state of the world. A named snapshot which already exists is replaced and its state in the
+        physics server is removed.
+        :param name: The name of the snapshot or None for an unnamed snapshot
+        :param record: If the poses and joint states of all objects should be recorded, which is needed for 'diff' and
+                        for restoring single objects
+        :return: The new WorldSnapshot
+        """
+        snapshot = self.world.save_snapshot(record)
+        if name is not None:
+            if name in self._named:
+                self.remove(name)
+            self._named[name] = snapshot
+        return snapshot
+
+    def get(self, name):
+        return self._named[name]
+
+    def names(self):
+        return list(self._named.keys())
+
+    def restore(self, snapshot, objects=None):
+        """
+        Restores a snapshot. If objects are given only their base poses and joint states are reset, which is cheaper
+        than restoring the whole world, e.g. for the objects which changed according to 'diff'.
+        :param snapshot: The WorldSnapshot or the name of a snapshot
+        :param objects: The objects which should be restored or None to restore the whole world
+        """
+        snapshot = self._resolve(snapshot)
+        if objects is not None:
+            if snapshot.states is None:
+                raise ValueError("Single objects can only be restored from snapshots which recorded the states")
+            for obj in objects:
+                position, orientation, joint_states = snapshot.states[obj]
+                p.resetBasePositionAndOrientation(obj.id, position, orientation, physicsClientId=self.world.client_id)
+                if len(joint_states):
+                    obj._reset_joint_states(None, joint_states)
+            self.world.increment_revision()
+            self.world.manipulation_event(self.world, list(objects))
+        elif snapshot.objects is None:
+            p.restoreState(snapshot.state_id, physicsClientId=self.world.client_id)
+            self.world.increment_revision()
+        else:
+            self.world.reset_to(snapshot)
+
+    def remove(self, snapshot):
+        """
+        Removes a snapshot and frees its state in the physics server.
+        :param snapshot: The WorldSnapshot or the name of a snapshot
+        """
+        snapshot = self._resolve(snapshot)
+        self._named = {name: named for name, named in self._named.items() if named is not snapshot}
+        p.removeState(snapshot.state_id, physicsClientId=self.world.client_id)
+
+    def clear(self):
+        """
+        Removes all named snapshots.
+        """
+        for name in self.names():
+            self.remove(name)
+
+    @contextmanager
+    def scoped(self, physics_only=False):
+        """
+        Saves the state of the world for the duration of a with block, restores it at the end of the block and removes
+        the snapshot afterwards.
+        :param physics_only: If True only the poses and joint states are restored and no events are fired. This is
+                                cheaper and meant for reasoning queries which change the world only temporarily and
+                                neither spawn, remove, attach nor detach objects.
+        """
+        if physics_only:
+            snapshot = WorldSnapshot(p.saveState(physicsClientId=self.world.client_id), None, None)
+        else:
+            snapshot = self.save(record=False)
+        try:
+            yield snapshot
+        finally:
+            self.restore(snapshot)
+            self.remove(snapshot)
+
+    def save_file(self, path):
+        """
+        Saves the physics state of the world to a .bullet file.
+        :param path: The path of the file
+        """
+        p.saveBullet(path, physicsClientId=self.world.client_id)
+
+    def restore_file(self, path):
+        """
+        Restores the physics state of the world from a .bullet file which was saved with 'save_file'. The world must
+        contain the same objects as the world the file was saved from, attachments are not restored.
+        :param path: The path of the file
+        """
+        p.restoreState(fileName=path, physicsClientId=self.world.client_id)
+        self.world.increment_revision()
+        self.world.manipulation_event(self.world, self.world.objects)
+
+    def diff(self, snapshot, other=None, tolerance=1e-6):
+        """
+        Computes which objects and joints changed between two snapshots. Both snapshots have to record the states.
+        :param snapshot: The older WorldSnapshot or the name of a snapshot
+        :param other: The newer WorldSnapshot or name, if None the current state of the world is used
+        :param tolerance: The maximal difference of a pose or joint state which counts as unchanged
+        :return: A SnapshotDiff
+        """
+        old = self._resolve(snapshot).states
+        new = record_states(self.world) if other is None else self._resolve(other).states
+        if old is None or new is None:
+            raise ValueError("Diffs can only be computed between snapshots which recorded the states")
+        moved, joints = [], {}
+        for obj in filter(lambda obj: obj in old, new):
+            old_position, old_orientation, old_joints = old[obj]
+            new_position, new_orientation, new_joints = new[obj]
+            if not (np.allclose(old_position, new_position, rtol=0, atol=tolerance) and
+                    np.allclose(old_orientation, new_orientation, rtol=0, atol=tolerance)):
+                moved.append(obj)
+            changed = np.flatnonzero(np.abs(np.asarray(old_joints) - np.asarray(new_joints)) > tolerance)
+            if len(changed):
+                joints[obj] = [obj.joint_names[i] for i in obj.movable_joints[changed]]
+        added = [obj for obj in new if obj not in old]
+        removed = [obj for obj in old if obj not in new]
+        return SnapshotDiff(moved, joints, added, removed)
+
+    def _resolve(self, snapshot):
+        return self._named[snapshot] if isinstance(snapshot, str) else snapshot
+
+
+def record_states(world):
+    """
+    Copies the base poses and the states of the movable joints of all objects of a world from its state mirror.
+    :param world: The BulletWorld
+    :return: A dictionary from every object to a tuple of its position, orientation and joint states
+    """
+    state = world.state_mirror.copy()
+    poses = state.get_poses()
+    return {obj: (poses[i, :3], poses[i, 3:], state.get_joint_states(obj)) for i, obj in enumerate(state.objects)}
@@ -0,0 +1,168 @@
+"""Implementation of an array based copy of the state of a BulletWorld
+
+Classes:
+WorldState -- The poses, joint states and attachments of all objects of a world stored in NumPy arrays
+WorldStateMirror -- A WorldState which is kept up to date with a BulletWorld
+"""
+
+import pybullet as p
+import numpy as np
+import threading
+
+
+class WorldState:
+    """
+    A WorldState holds the base poses of all objects as a Nx7 array with rows of x,y,z position and x,y,z,w orientation,
+    the states of the movable joints of every object as NumPy array and the attachments as a dictionary from every
+    parent object to the list of objects attached to it. The rows of the pose matrix are in the order of 'objects'.
+    """
+
+    def __init__(self, objects=None, poses=None, joint_states=None, attachments=None):
+        """
+        :param objects: The list of objects
+        :param poses: The Nx7 array of base poses in the order of the objects
+        :param joint_states: A dictionary from every object to the NumPy array of its movable joint states
+        :param attachments: A dictionary from every object to the list of objects attached to it
+        """
+        self.objects = [] if objects is None else objects
+        self._poses = np.empty((0, 7)) if poses is None else poses
+        self._joint_states = {} if joint_states is None else joint_states
+        self._attachments = {} if attachments is None else attachments
+        self._index = {obj: i for i, obj in enumerate(self.objects)}
+
+    def get_poses(self, objects=None):
+        """
+        Returns the base poses of many objects.
+        :param objects: The objects, if None the whole Nx7 matrix is returned without copying it
+        :return: An array with one row of x,y,z position and x,y,z,w orientation per object
+        """
+        self._refresh()
+        if objects is None:
+            return self._poses
+        return self._poses[[self._index[obj] for obj in objects]]
+
+    def get_pose(self, object):
+        """
+        :return: The position and the orientation of the base of the object as NumPy arrays
+        """
+        row = self.get_poses()[self._index[object]]
+        return row[:3], row[3:]
+
+    def get_joint_states(self, object):
+        """
+        :return: The states of the movable joints of the object in the order of 'movable_joints' of the object
+        """
+        self._refresh()
+        return self._joint_states[object]
+
+    def get_attachments(self, object):
+        """
+        :return: The list of objects which are attached to the given object
+        """
+        return list(self._attachments.get(object, []))
+
+    def copy(self):
+        """
+        Copies the complete state, the copy is not changed by later changes of the world.
+        :return: A new WorldState
+        """
+        poses = self.get_poses().copy()
+        joint_states = {obj: states.copy() for obj, states in self._joint_states.items()}
+        attachments = {obj: list(children) for obj, children in self._attachments.items()}
+        return WorldState(list(self.objects), poses, joint_states, attachments)
+
+    def _refresh(self):
+        pass
+
+
+class WorldStateMirror(WorldState):
+    """
+    The WorldStateMirror is a WorldState which mirrors a BulletWorld. Objects are added and removed with the world, the
+    attachments are updated by the attachment and detachment events and the objects which are named by the
+    manipulation event are read again lazily the next time the state is accessed. If the simulation is changed by
+    calling pybullet directly, 'update' has to be called for the changed objects.
+    Every BulletWorld has its own mirror as 'state_mirror'. The manipulation event may be fired from the thread of
+    'simulate_async', so the changed objects are guarded by a lock.
+    """
+
+    def __init__(self, world):
+        """
+        :param world: The BulletWorld which should be mirrored
+        """
+        WorldState.__init__(self)
+        self.world = world
+        # The pose matrix is a view of the first rows of a larger buffer which grows geometrically, so adding N
+        # objects copies the poses only O(log N) times
+        self._buffer = np.empty((8, 7))
+        self._dirty = set()
+        self._lock = threading.Lock()
+        world.manipulation_event.add(self._on_manipulation)
+        world.attachment_event.add(self._on_attachment)
+        world.detachment_event.add(self._on_detachment)
+
+    def add(self, object):
+        """
+        Adds an object to the mirror, its state is read the next time the state is accessed.
+        :param object: The object which should be added
+        """
+        with self._lock:
+            rows = len(self.objects)
+            if rows == len(self._buffer):
+                buffer = np.empty((2 * len(self._buffer), 7))
+                buffer[:rows] = self._buffer
+                self._buffer = buffer
+            self._buffer[rows] = 0
+            self._poses = self._buffer[:rows + 1]
+            self._index[object] = rows
+            self.objects.append(object)
+            self._joint_states[object] = np.zeros(len(object.movable_joints))
+            self._dirty.add(object)
+
+    def remove(self, object):
+        """
+        Removes an object and its attachments from the mirror.
+        :param object: The object which should be removed
+        """
+        with self._lock:
+            row = self._index.pop(object)
+            del self.objects[row]
+            self._buffer[row:-1] = self._buffer[row + 1:]
+            self._poses = self._buffer[:len(self.objects)]
+            self._index = {obj: i for i, obj in enumerate(self.objects)}
+            del self._joint_states[object]
+            self._attachments.pop(object, None)
+            for children in self._attachments.values():
+                if object in children:
+                    children.remove(object)
+            self._dirty.discard(object)
+
+    def update(self, object=None):
+        """
+        Marks an object as changed, so its state is read again the next time the state is accessed.
+        :param object: The object which changed, if None all objects are marked as changed
+        """
+        with self._lock:
+            self._dirty.update(self.objects if object is None else [object])
+
+    def _refresh(self):
+        with self._lock:
+            for obj in self._dirty:
+                position, orientation = p.getBasePositionAndOrientation(obj.id, physicsClientId=self.world.client_id)
+                self._poses[self._index[obj]] = position + orientation
+                self._joint_states[obj] = obj.get_joint_states()
+            self._dirty.clear()
+
+    def _on_manipulation(self, sender, objects):
+        with self._lock:
+            self._dirty.update(filter(lambda obj: obj in self._index, objects))
+
+    def _on_attachment(self, sender, objects):
+        parent, child = objects
+        self._attachments.setdefault(parent, []).append(child)
+
+    def _on_detachment(self, sender, objects):
+        for parent, child in (objects, objects[::-1]):
+            if child in self._attachments.get(parent, []):
+                self._attachments[parent].remove(child)
+                if not self._attachments[parent]:
+                    del self._attachments[parent]